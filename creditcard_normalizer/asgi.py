@@ -14,3 +14,12 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'creditcard_normalizer.settings')
 
 application = get_asgi_application()
+
+# Pay the first-request costs now; under gunicorn's preload_app this runs once
+# in the master and forked workers share the result copy-on-write. The parse
+# pool can't be shared that way, so gunicorn starts it in each worker instead.
+from django.conf import settings
+
+if settings.WARM_UP_ON_START:
+    from normalizer.utils.warmup import warm_up_web
+    warm_up_web(start_pool=settings.START_PARSE_POOL_ON_LOAD)
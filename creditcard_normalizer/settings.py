@@ -128,5 +128,41 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Artifact store for uploads and outputs, sharded under ARTIFACT_ROOT
+# Artifacts older than ARTIFACT_TTL seconds are removed, then the oldest ones until
+# the store fits in ARTIFACT_MAX_BYTES; one process sweeps the store every ARTIFACT_SWEEP_INTERVAL seconds
+ARTIFACT_ROOT = os.environ.get('ARTIFACT_ROOT', os.path.join(MEDIA_ROOT, 'artifacts'))
+ARTIFACT_TTL = int(os.environ.get('ARTIFACT_TTL', 24 * 60 * 60))
+ARTIFACT_MAX_BYTES = int(os.environ.get('ARTIFACT_MAX_BYTES', 1024 * 1024 * 1024))
+ARTIFACT_SWEEP_INTERVAL = int(os.environ.get('ARTIFACT_SWEEP_INTERVAL', 5 * 60))
+
+# Statement parsing concurrency (used by the async upload view)
+# Parses run in a process pool of PARSE_MAX_PARALLEL workers (defaults to the core count);
+# at most PARSE_MAX_WAITING further uploads may queue before new ones are turned away
+PARSE_MAX_PARALLEL = int(os.environ.get('PARSE_MAX_PARALLEL', 0)) or None
+PARSE_MAX_WAITING = int(os.environ.get('PARSE_MAX_WAITING', 256))
+
+# Largest chunk accepted by the resumable upload API (uploads/<id>/chunks/)
+CHUNKED_UPLOAD_MAX_CHUNK_SIZE = int(os.environ.get('CHUNKED_UPLOAD_MAX_CHUNK_SIZE', 8 * 1024 * 1024))
+
+# Compression of standardized outputs on disk: 'gzip', or '' to store plain CSV
+OUTPUT_COMPRESSION = os.environ.get('OUTPUT_COMPRESSION', 'gzip') or None
+
+# Lookup data of the parser (names, cities, keywords), compiled from REFERENCE_TABLES_SOURCE
+# into REFERENCE_TABLES_PATH, which every worker maps read-only; a changed source or a newly
+# compiled file is picked up within REFERENCE_TABLES_CHECK_INTERVAL seconds, without a restart
+REFERENCE_TABLES_SOURCE = os.environ.get('REFERENCE_TABLES_SOURCE', os.path.join(BASE_DIR, 'normalizer', 'data', 'reference_tables.json'))
+REFERENCE_TABLES_PATH = os.environ.get('REFERENCE_TABLES_PATH', os.path.join(MEDIA_ROOT, 'reference', 'tables.bin'))
+REFERENCE_TABLES_CHECK_INTERVAL = int(os.environ.get('REFERENCE_TABLES_CHECK_INTERVAL', 5))
+
+# Warm up URLs, templates and every bank parser when the WSGI/ASGI application loads
+WARM_UP_ON_START = os.environ.get('WARM_UP_ON_START', '1') == '1'
+# Also start the parse processes then; gunicorn.conf.py turns this off and starts them
+# in each worker, since a process pool started in the master doesn't survive the fork
+START_PARSE_POOL_ON_LOAD = os.environ.get('START_PARSE_POOL_ON_LOAD', '1') == '1'
+
+# Target latency of the first upload after a cold start, checked by `manage.py profile_startup`
+FIRST_UPLOAD_TARGET_MS = int(os.environ.get('FIRST_UPLOAD_TARGET_MS', 100))
+
 # Configure messages
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
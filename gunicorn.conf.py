@@ -0,0 +1,19 @@
+# Gunicorn settings, picked up automatically from the working directory
+import os
+
+# Import the application (and run its warm-up) once in the master, so every
+# forked worker starts with Django, the parser and its tables already loaded
+preload_app = True
+
+# The parse pool can't be inherited through the fork; each worker starts its
+# own once it is up (see post_worker_init)
+os.environ['START_PARSE_POOL_ON_LOAD'] = '0'
+
+
+def post_worker_init(worker):
+    """Starts and warms up the worker's parse processes before it takes requests"""
+    from django.conf import settings
+
+    if settings.WARM_UP_ON_START:
+        from normalizer.utils.workers import start_parse_pool
+        worker.log.info('Parse pool started in %.1f ms', start_parse_pool())
@@ -0,0 +1,100 @@
+import csv
+import mmap
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from normalizer.utils.loadtest import generate_statement
+from normalizer.utils.parser import STATEMENT_FORMATS, StatementRowParser, detect_bank_format
+from normalizer.utils.reader import SNIFF_SAMPLE_SIZE, StatementFile, iter_buffer_blocks, sniff_dialect, sniff_encoding
+
+
+def _split_statement_file(file_path, bank_format):
+    with StatementFile(file_path) as statement:
+        return sum(1 for _ in statement.rows())
+
+
+def _split_csv_reader(file_path, bank_format):
+    with open(file_path, newline='', encoding='utf-8-sig') as file:
+        return sum(1 for _ in csv.reader(file))
+
+
+def _sniff(file):
+    """Returns the encoding, data start and dialect, as the chunked upload parser sniffs them"""
+    sample = file.read(SNIFF_SAMPLE_SIZE)
+    encoding, start = sniff_encoding(sample)
+    return encoding, start, sniff_dialect(sample.decode(encoding, errors='ignore'))
+
+
+def _split_buffer_blocks(file_path, bank_format):
+    with open(file_path, 'rb') as file:
+        encoding, start, dialect = _sniff(file)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return sum(len(rows) for rows, _ in iter_buffer_blocks(data, start, len(data), encoding, dialect))
+
+
+def _parse(rows, bank_format):
+    parser = StatementRowParser(bank_format)
+    return sum(1 for line in rows if parser.feed(line))
+
+
+def _parse_statement_file(file_path, bank_format):
+    with StatementFile(file_path) as statement:
+        return _parse(statement.rows(), bank_format)
+
+
+def _parse_csv_reader(file_path, bank_format):
+    with open(file_path, newline='', encoding='utf-8-sig') as file:
+        return _parse(csv.reader(file), bank_format)
+
+
+def _parse_buffer_blocks(file_path, bank_format):
+    with open(file_path, 'rb') as file:
+        encoding, start, dialect = _sniff(file)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            blocks = iter_buffer_blocks(data, start, len(data), encoding, dialect)
+            return _parse((line for rows, _ in blocks for line in rows), bank_format)
+
+
+# What is timed: name, function(file_path, bank_format) returning a count
+BENCHMARKS = (
+    ('split: StatementFile', _split_statement_file),
+    ('split: chunked upload blocks', _split_buffer_blocks),
+    ('split: csv.reader (baseline)', _split_csv_reader),
+    ('parse: StatementFile', _parse_statement_file),
+    ('parse: chunked upload blocks', _parse_buffer_blocks),
+    ('parse: csv.reader (baseline)', _parse_csv_reader),
+)
+
+
+class Command(BaseCommand):
+    help = ('Times how fast statements are split into rows and parsed by the statement reader, the '
+            'chunked upload reader and a plain csv.reader')
+
+    def add_arguments(self, parser):
+        parser.add_argument('statement', nargs='?',
+                            help='Plain CSV statement to read (default: a generated HDFC statement)')
+        parser.add_argument('--rows', type=int, default=200000, help='Transactions of the generated statement')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark; the best is shown')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory(prefix='benchmark-') as temp_dir:
+            file_path = options['statement']
+            if file_path is None:
+                file_path = os.path.join(temp_dir, 'hdfc-benchmark.csv')
+                with open(file_path, 'w', encoding='utf-8', newline='') as file:
+                    file.write(generate_statement('hdfc', options['rows']))
+            bank_format = detect_bank_format(file_path)
+            if bank_format not in STATEMENT_FORMATS:
+                raise CommandError(f'Could not detect the bank of {file_path}')
+
+            self.stdout.write(f'{file_path}: {os.path.getsize(file_path) / 1024 / 1024:.1f} MB, {bank_format}')
+            for name, function in BENCHMARKS:
+                timings = []
+                for _ in range(max(options['repeat'], 1)):
+                    started = time.perf_counter()
+                    count = function(file_path, bank_format)
+                    timings.append(time.perf_counter() - started)
+                self.stdout.write(f'{name:<32}{min(timings):>8.2f} s{count:>12} rows')
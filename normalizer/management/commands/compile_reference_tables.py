@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from normalizer.utils.reftables import get_table_loader, compile_tables, load_source
+
+
+class Command(BaseCommand):
+    help = ('Compiles the parser reference tables into the memory-mapped file shared by all workers; '
+            'running workers switch to the new tables within REFERENCE_TABLES_CHECK_INTERVAL seconds')
+
+    def add_arguments(self, parser):
+        loader = get_table_loader()
+        parser.add_argument('--source', default=loader.source_path,
+                            help='JSON file of tables (default: REFERENCE_TABLES_SOURCE)')
+        parser.add_argument('--output', default=loader.path,
+                            help='Compiled file to replace (default: REFERENCE_TABLES_PATH)')
+
+    def handle(self, *args, **options):
+        try:
+            tables = load_source(options['source'])
+            version = compile_tables(options['source'], options['output'])
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Could not compile {options["source"]}: {e}')
+
+        for name, (columns, rows) in tables.items():
+            self.stdout.write(f'{name}: {len(rows)} rows')
+        self.stdout.write(self.style.SUCCESS(f"Wrote version {version} to {options['output']}"))
@@ -0,0 +1,267 @@
+import importlib.util
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from normalizer.utils.loadtest import LoadClient, MemorySampler, run_load, summarize, write_statements
+from normalizer.utils.parser import STATEMENT_FORMATS
+
+# Latency and throughput figures compared against a baseline report
+COMPARED_METRICS = ('p50', 'p95', 'p99', 'throughput', 'error_rate')
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _megabytes(kilobytes):
+    return f'{kilobytes / 1024:.1f}' if kilobytes is not None else '-'
+
+
+def _memory_kb(memory):
+    """PSS of a process sample, or its RSS where PSS can't be read"""
+    return memory['pss'] if memory['pss'] is not None else memory['rss']
+
+
+class Command(BaseCommand):
+    help = ('Boots the app under gunicorn and replays generated statements of several banks and sizes '
+            'at a given concurrency; reports latency percentiles, throughput, error rate and '
+            'per-worker memory over time')
+
+    def add_arguments(self, parser):
+        server = parser.add_argument_group('server')
+        server.add_argument('--worker-class', default='sync',
+                            help='gunicorn worker class, e.g. sync, gthread or uvicorn.workers.UvicornWorker '
+                                 '(which serves the ASGI application)')
+        server.add_argument('--workers', type=int, default=2, help='Number of gunicorn workers')
+        server.add_argument('--threads', type=int, default=1, help='Threads per gunicorn worker')
+        server.add_argument('--gunicorn-arg', action='append', default=[], dest='gunicorn_args',
+                            help='Extra argument passed to gunicorn; may be given several times')
+        server.add_argument('--url', help='Load an already running server instead of booting one')
+        server.add_argument('--pid', type=int, help='Process id of the --url server, to sample its memory')
+        server.add_argument('--startup-timeout', type=float, default=60, help='Seconds to wait for the server')
+
+        load = parser.add_argument_group('load')
+        load.add_argument('--requests', type=int, default=100, help='Number of statements to upload')
+        load.add_argument('--concurrency', type=int, default=8, help='Uploads in flight at once')
+        load.add_argument('--banks', default=','.join(STATEMENT_FORMATS),
+                          help='Comma separated bank formats to mix (default: all)')
+        load.add_argument('--sizes', default='20,1000,10000',
+                          help='Comma separated transaction counts of the generated statements')
+        load.add_argument('--seed', type=int, default=0, help='Seed of the statement mix, for repeatable runs')
+        load.add_argument('--sample-interval', type=float, default=1.0, help='Seconds between memory samples')
+
+        report = parser.add_argument_group('report')
+        report.add_argument('--output', help='Write the full report (settings, results, memory samples) as JSON')
+        report.add_argument('--baseline', help='JSON report of an earlier run to compare against')
+
+    def handle(self, *args, **options):
+        banks = [bank.strip() for bank in options['banks'].split(',') if bank.strip()]
+        unknown = [bank for bank in banks if bank not in STATEMENT_FORMATS]
+        if unknown or not banks:
+            raise CommandError(f"Unknown bank formats: {', '.join(unknown) or 'none given'}")
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError(f"Invalid sizes: {options['sizes']}")
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as file:
+                baseline = json.load(file)
+
+        with tempfile.TemporaryDirectory(prefix='load-test-') as temp_dir:
+            statements = write_statements(temp_dir, banks, sizes, options['seed'])
+            server = None
+            if options['url']:
+                base_url, server_pid = options['url'], options['pid']
+            else:
+                server, base_url = self.start_server(options, temp_dir)
+                server_pid = server.pid
+            try:
+                self.wait_until_ready(base_url, server, options['startup_timeout'], temp_dir)
+                report = self.run(options, base_url, server_pid, statements, banks, sizes)
+            finally:
+                if server is not None:
+                    server.terminate()
+                    try:
+                        server.wait(timeout=30)
+                    except subprocess.TimeoutExpired:
+                        server.kill()
+
+        self.print_report(report, baseline)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                json.dump(report, file, indent=1)
+            self.stdout.write(f"Report written to {options['output']}")
+
+    def start_server(self, options, temp_dir):
+        """
+        Starts gunicorn on a free local port, with the repository's
+        gunicorn.conf.py and an artifact store in `temp_dir`
+        """
+        if importlib.util.find_spec('gunicorn') is None:
+            raise CommandError('gunicorn is not installed; install the requirements or pass --url')
+        asgi = 'uvicorn' in options['worker_class'].lower()
+        application = 'creditcard_normalizer.asgi:application' if asgi else 'creditcard_normalizer.wsgi:application'
+        port = _free_port()
+        command = [
+            sys.executable, '-m', 'gunicorn', application,
+            '--bind', f'127.0.0.1:{port}',
+            '--worker-class', options['worker_class'],
+            '--workers', str(options['workers']),
+            '--threads', str(options['threads']),
+            '--timeout', '300',
+        ] + options['gunicorn_args']
+
+        env = dict(os.environ)
+        env['DJANGO_SETTINGS_MODULE'] = os.environ.get('DJANGO_SETTINGS_MODULE', 'creditcard_normalizer.settings')
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(settings.BASE_DIR), env.get('PYTHONPATH')]))
+        env['ARTIFACT_ROOT'] = os.path.join(temp_dir, 'artifacts')
+        with open(os.path.join(temp_dir, 'server.log'), 'wb') as log:
+            server = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.stdout.write(f"Started gunicorn ({options['workers']} x {options['worker_class']}, "
+                          f"{options['threads']} threads) on port {port}")
+        return server, f'http://127.0.0.1:{port}'
+
+    def wait_until_ready(self, base_url, server, timeout, temp_dir):
+        """Waits until the server answers on the upload form"""
+        client = self.make_client(base_url)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                client.fetch_csrf_token()
+                return
+            except OSError as e:
+                if server is not None and server.poll() is not None:
+                    with open(os.path.join(temp_dir, 'server.log'), encoding='utf-8', errors='replace') as log:
+                        output = log.read()[-2000:]
+                    raise CommandError(f'Server exited during startup:\n{output}')
+                if time.time() > deadline:
+                    raise CommandError(f'Server did not become ready in {timeout:.0f}s: {e}')
+                time.sleep(0.2)
+
+    def make_client(self, base_url):
+        # The server only answers to the hosts it allows
+        host = settings.ALLOWED_HOSTS[0].lstrip('.') if settings.ALLOWED_HOSTS else None
+        return LoadClient(base_url, host=None if host == '*' else host)
+
+    def run(self, options, base_url, server_pid, statements, banks, sizes):
+        client = self.make_client(base_url)
+        client.fetch_csrf_token()
+
+        sampler = None
+        if server_pid and MemorySampler.available():
+            sampler = MemorySampler(server_pid, options['sample_interval'])
+        elif server_pid:
+            self.stdout.write(self.style.WARNING('Memory sampling needs /proc; skipped'))
+
+        self.stdout.write(f"Uploading {options['requests']} statements with concurrency {options['concurrency']}")
+        started = time.perf_counter()
+        if sampler is not None:
+            with sampler:
+                results = run_load(client, statements, options['requests'], options['concurrency'], options['seed'])
+        else:
+            results = run_load(client, statements, options['requests'], options['concurrency'], options['seed'])
+        elapsed = time.perf_counter() - started
+
+        return {
+            'settings': {
+                'server': options['url'] or 'gunicorn',
+                'worker_class': None if options['url'] else options['worker_class'],
+                'workers': None if options['url'] else options['workers'],
+                'threads': None if options['url'] else options['threads'],
+                'gunicorn_args': options['gunicorn_args'],
+                'requests': options['requests'],
+                'concurrency': options['concurrency'],
+                'banks': banks,
+                'sizes': sizes,
+                'seed': options['seed'],
+                'cpus': os.cpu_count(),
+                'python': platform.python_version(),
+            },
+            'finished': time.time(),
+            'elapsed': round(elapsed, 3),
+            'summary': summarize(results, elapsed),
+            'memory': {
+                'processes': sampler.summary() if sampler else {},
+                'samples': sampler.samples if sampler else [],
+            },
+            'results': results,
+        }
+
+    def print_report(self, report, baseline=None):
+        self.stdout.write(f"\nFinished in {report['elapsed']:.2f}s")
+        self.stdout.write(f"{'endpoint':<10}{'requests':>9}{'errors':>8}{'rate':>8}{'req/s':>8}"
+                          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for endpoint, stats in report['summary'].items():
+            values = [stats[key] for key in ('p50', 'p95', 'p99', 'max')]
+            self.stdout.write(f"{endpoint:<10}{stats['requests']:>9}{stats['errors']:>8}"
+                              f"{stats['error_rate']:>8.1%}{stats['throughput']:>8.2f}"
+                              + ''.join(f"{value if value is not None else '-':>10}" for value in values))
+            for message in stats['error_messages']:
+                self.stdout.write(self.style.WARNING(f'  {message}'))
+
+        processes = report['memory']['processes']
+        if processes:
+            self.stdout.write(f"\n{'process':<18}{'first MB':>10}{'peak MB':>10}{'last MB':>10}   (PSS, or RSS)")
+            for pid, memory in sorted(processes.items(), key=lambda item: (item[1]['role'] != 'master', item[0])):
+                kind = 'pss' if memory['first_pss'] is not None else 'rss'
+                self.stdout.write(f"{memory['role'] + ' ' + pid:<18}{_megabytes(memory['first_' + kind]):>10}"
+                                  f"{_megabytes(memory['peak_' + kind]):>10}{_megabytes(memory['last_' + kind]):>10}")
+            self.print_timeline(report['memory']['samples'])
+
+        if baseline is not None:
+            self.print_comparison(report, baseline)
+
+    def print_timeline(self, samples, rows=10):
+        """Prints the memory of every worker at up to `rows` evenly spaced samples"""
+        workers = sorted({pid for sample in samples for pid, memory in sample['processes'].items()
+                          if memory['role'] == 'worker'})
+        if not workers:
+            return
+        step = max(1, len(samples) // rows)
+        self.stdout.write('\nWorker memory over time (MB)')
+        self.stdout.write(f"{'time s':>8}" + ''.join(f'{pid:>10}' for pid in workers) + f"{'total':>10}")
+        for sample in samples[::step] + ([samples[-1]] if (len(samples) - 1) % step else []):
+            processes = sample['processes']
+            values = [_memory_kb(processes[pid]) if pid in processes else None for pid in workers]
+            total = sum(_memory_kb(memory) or 0 for memory in processes.values())
+            self.stdout.write(f"{sample['time']:>8.1f}" + ''.join(f'{_megabytes(value):>10}' for value in values)
+                              + f'{_megabytes(total):>10}')
+
+    def print_comparison(self, report, baseline):
+        differences = [f'{key}={value}' for key, value in baseline['settings'].items()
+                       if value != report['settings'].get(key)]
+        self.stdout.write('\nCompared with the baseline'
+                          + (f" (which had {', '.join(differences)})" if differences else ''))
+        for endpoint, stats in report['summary'].items():
+            before = baseline['summary'].get(endpoint, {})
+            changes = []
+            for metric in COMPARED_METRICS:
+                old, new = before.get(metric), stats[metric]
+                if old is None or new is None:
+                    continue
+                change = f' ({(new - old) / old:+.0%})' if old else ''
+                changes.append(f'{metric} {old} -> {new}{change}')
+            self.stdout.write(f"{endpoint:<10}{'; '.join(changes)}")
+
+        peak, old_peak = _peak_memory(report), _peak_memory(baseline)
+        if peak and old_peak:
+            self.stdout.write(f'{"memory":<10}peak total {_megabytes(old_peak)} -> {_megabytes(peak)} MB '
+                              f'({(peak - old_peak) / old_peak:+.0%})')
+
+
+def _peak_memory(report):
+    """Highest total memory of the server's processes over one run, in kB"""
+    return max((sum(_memory_kb(memory) or 0 for memory in sample['processes'].values())
+                for sample in report['memory']['samples']), default=0)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from normalizer.utils.ledger import merge_statements, DEFAULT_MEMORY_BUDGET
+
+
+class Command(BaseCommand):
+    help = 'Merges standardized statement outputs into a single date-ordered ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('inputs', nargs='+', help='Standardized CSV files, in tie-break order')
+        parser.add_argument('-o', '--output', required=True, help='Path of the merged ledger CSV')
+        parser.add_argument('--memory-mb', type=int, default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+                            help='Memory budget for sorting, in MB')
+        parser.add_argument('--temp-dir', default=None, help='Directory for sorted runs spilled to disk')
+
+    def handle(self, *args, **options):
+        if options['memory_mb'] <= 0:
+            raise CommandError('--memory-mb must be positive')
+        count = merge_statements(options['inputs'], options['output'],
+                                 memory_budget=options['memory_mb'] * 1024 * 1024,
+                                 temp_dir=options['temp_dir'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {count} rows to {options["output"]}'))
@@ -0,0 +1,83 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter so that nothing is imported or cached yet
+PROFILE_SCRIPT = r'''
+import json, os, sys, tempfile, time
+started = time.perf_counter()
+timings = {}
+
+def mark(name):
+    global started
+    now = time.perf_counter()
+    timings[name] = round((now - started) * 1000, 2)
+    started = now
+
+import django
+from django.conf import settings
+django.setup()
+mark('django_setup')
+
+import dateutil.parser
+mark('import_dateutil')
+
+from creditcard_normalizer.wsgi import application
+mark('load_application')
+
+from django.test import Client
+settings.ARTIFACT_ROOT = tempfile.mkdtemp(prefix='profile-')
+settings.ARTIFACT_SWEEP_INTERVAL = 0
+client = Client(HTTP_HOST=(settings.ALLOWED_HOSTS or ['testserver'])[0])
+
+for name in ('first_upload', 'second_upload'):
+    with open(sys.argv[1], 'rb') as statement:
+        response = client.post('/upload/', {'statement_file': statement})
+    if response.status_code != 200:
+        sys.exit(f'Upload failed with status {response.status_code}')
+    mark(name)
+
+print(json.dumps(timings))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Measures import, warm-up and first-upload latency of a cold web process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('statement', help='Statement CSV to upload, e.g. HDFC-Input-Case1.csv')
+        parser.add_argument('--no-warm-up', action='store_true', help='Profile without the startup warm-up')
+        parser.add_argument('--runs', type=int, default=3, help='Number of cold starts to average')
+        parser.add_argument('--check', action='store_true',
+                            help='Fail if the first upload is slower than FIRST_UPLOAD_TARGET_MS')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ)
+        env['DJANGO_SETTINGS_MODULE'] = os.environ.get('DJANGO_SETTINGS_MODULE', 'creditcard_normalizer.settings')
+        env['WARM_UP_ON_START'] = '0' if options['no_warm_up'] else '1'
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(settings.BASE_DIR), env.get('PYTHONPATH')]))
+
+        runs = []
+        for _ in range(max(options['runs'], 1)):
+            result = subprocess.run([sys.executable, '-c', PROFILE_SCRIPT, os.path.abspath(options['statement'])],
+                                    env=env, cwd=settings.BASE_DIR, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise CommandError(result.stderr.strip() or 'Profiling run failed')
+            runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+        for phase in runs[0]:
+            values = [run[phase] for run in runs]
+            self.stdout.write(f'{phase:<18} {sum(values) / len(values):>9.2f} ms   (min {min(values):.2f}, max {max(values):.2f})')
+
+        first_upload = sum(run['first_upload'] for run in runs) / len(runs)
+        target = settings.FIRST_UPLOAD_TARGET_MS
+        if first_upload <= target:
+            self.stdout.write(self.style.SUCCESS(f'First upload {first_upload:.2f} ms is within the {target} ms target'))
+        elif options['check']:
+            raise CommandError(f'First upload {first_upload:.2f} ms exceeds the {target} ms target')
+        else:
+            self.stdout.write(self.style.WARNING(f'First upload {first_upload:.2f} ms exceeds the {target} ms target'))
@@ -0,0 +1,63 @@
+import time
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand, CommandError
+
+from normalizer.utils.artifacts import get_artifact_store
+from normalizer.utils.parser import RULE_FAMILIES
+from normalizer.utils.renormalize import outdated_families, renormalize_output
+
+
+class Command(BaseCommand):
+    help = ('Re-applies changed rules (reference tables or rule code) to stored outputs from their provenance, '
+            'recomputing only the affected columns of the rows produced with an older version of the rules')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*',
+                            help='Standardized outputs to update (default: every output in the artifact store)')
+        parser.add_argument('--family', action='append', choices=sorted(RULE_FAMILIES), dest='families',
+                            help='Only re-apply this rule family; may be given several times (default: all)')
+        parser.add_argument('--check', action='store_true',
+                            help='Only list the outputs that are out of date, without changing them')
+
+    def handle(self, *args, **options):
+        store = get_artifact_store()
+        # (path, artifact id) of each output; ids are only known for stored outputs
+        outputs = [(path, None) for path in options['paths']]
+        if not outputs:
+            outputs = [(store.path(metadata['id'], metadata), metadata['id']) for metadata in store.artifacts('output')]
+
+        totals = {'outputs': 0, 'updated': 0, 'skipped': 0, 'rows': 0, 'changed_rows': 0}
+        started = time.time()
+        for path, artifact_id in outputs:
+            totals['outputs'] += 1
+            try:
+                stale = outdated_families(path, options['families'])
+            except ValueError as e:
+                raise CommandError(f'Could not read the provenance of {path}: {e}')
+            if stale is None:
+                totals['skipped'] += 1
+                self.stdout.write(f'{path}: no provenance, skipped')
+                continue
+            if not stale:
+                continue
+            if options['check']:
+                self.stdout.write(f"{path}: out of date ({', '.join(stale)})")
+                continue
+
+            try:
+                swap_lock = store.lock(artifact_id) if artifact_id else nullcontext()
+                stats = renormalize_output(path, options['families'], swap_lock)
+            except (OSError, ValueError) as e:
+                raise CommandError(f'Could not re-normalize {path}: {e}')
+            totals['updated'] += 1
+            totals['rows'] += stats['rows']
+            totals['changed_rows'] += stats['changed_rows']
+            changed = ', '.join(f'{column} {count}' for column, count in stats['changed'].items() if count)
+            self.stdout.write(f"{path}: {stats['changed_rows']} of {stats['rows']} rows changed"
+                              + (f' ({changed})' if changed else ''))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {totals['outputs']} outputs in {time.time() - started:.2f}s: {totals['updated']} updated, "
+            f"{totals['skipped']} without provenance, {totals['changed_rows']} of {totals['rows']} rows changed"
+        ))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from normalizer.utils.artifacts import get_artifact_store
+
+
+class Command(BaseCommand):
+    help = 'Removes expired uploads and outputs and enforces the artifact disk quota'
+
+    def handle(self, *args, **options):
+        stats = get_artifact_store().sweep()
+        self.stdout.write(self.style.SUCCESS(
+            f"Scanned {stats['scanned']} artifacts: {stats['expired']} expired, "
+            f"{stats['evicted']} evicted for quota, {stats['in_use']} in use, {stats['bytes_freed']} bytes freed, "
+            f"{stats['bytes_remaining']} bytes remaining"
+        ))
@@ -1,3 +1,492 @@
-from django.test import TestCase
+import codecs
+import csv
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+from .utils import artifacts, chunked
+from .utils.artifacts import ArtifactStore, CHUNKED_UPLOAD_KIND
+from .utils.loadtest import generate_statement
+from .utils.parser import OUTPUT_FIELDS, StatementRowParser, rule_fingerprints, standardize_statement
+from .utils.provenance import RULES_SUFFIX, ProvenanceWriter, read_rules_summary
+from .utils.reader import StatementFile, is_byte_splittable, iter_buffer_blocks, make_dialect, sniff_encoding
+from .utils.reftables import ReferenceTables, compile_tables
+from .utils.renormalize import RENORMALIZING_SUFFIX, outdated_families, renormalize_output
+from .utils.rowindex import INDEX_SUFFIX, IndexedCsvWriter, RowIndex, open_standardized
+
+
+def setUpModule():
+    # Compile the reference tables into a temporary directory instead of
+    # media/; the parse processes the tests start read the path from the environment
+    tables_dir = tempfile.mkdtemp(prefix='normalizer-tables-')
+    unittest.addModuleCleanup(shutil.rmtree, tables_dir, ignore_errors=True)
+    tables_path = os.path.join(tables_dir, 'tables.bin')
+    settings_override = override_settings(REFERENCE_TABLES_PATH=tables_path)
+    settings_override.enable()
+    unittest.addModuleCleanup(settings_override.disable)
+    for patcher in (mock.patch.dict(os.environ, REFERENCE_TABLES_PATH=tables_path),
+                    mock.patch('normalizer.utils.reftables._loader', None)):
+        patcher.start()
+        unittest.addModuleCleanup(patcher.stop)
+
+
+def make_tables(directory, name, **changes):
+    """
+    Compiles the shipped reference tables into `directory`, with each table
+    named in `changes` replaced by change(rows), and returns them
+    """
+    with open(settings.REFERENCE_TABLES_SOURCE, encoding='utf-8') as file:
+        source = json.load(file)
+    for table, change in changes.items():
+        source[table] = change(source[table])
+    source_path = os.path.join(directory, f'{name}.json')
+    with open(source_path, 'w', encoding='utf-8') as file:
+        json.dump(source, file)
+    compile_tables(source_path, os.path.join(directory, f'{name}.bin'))
+    return ReferenceTables(os.path.join(directory, f'{name}.bin'))
+
+
+class ChunkedUploadTests(SimpleTestCase):
+    """
+    Resumable uploads through the HTTP endpoints, against an artifact store
+    in a temporary directory
+    """
+
+    # Large enough to be parsed incrementally, in several chunks
+    CHUNK_SIZE = 32 * 1024
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='normalizer-tests-')
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        patcher = mock.patch('normalizer.utils.artifacts._store', ArtifactStore(os.path.join(self.temp_dir, 'store')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.statement_path = os.path.join(self.temp_dir, 'HDFC-statement.csv')
+        with open(self.statement_path, 'w', encoding='utf-8', newline='') as file:
+            file.write(generate_statement('hdfc', 3000))
+        with open(self.statement_path, 'rb') as file:
+            self.data = file.read()
+        self.assertGreater(len(self.data), 4 * self.CHUNK_SIZE)
+
+    def init_upload(self):
+        response = self.client.post('/uploads/', {'filename': 'HDFC-statement.csv', 'size': len(self.data)})
+        self.assertEqual(response.status_code, 201)
+        return response.json()['upload_id']
+
+    def send_chunk(self, upload_id, offset, checksum=None):
+        chunk = self.data[offset:offset + self.CHUNK_SIZE]
+        return self.client.post(f'/uploads/{upload_id}/chunks/?offset={offset}', chunk,
+                                content_type='application/octet-stream',
+                                headers={'X-Chunk-Sha256': checksum or hashlib.sha256(chunk).hexdigest()})
+
+    def chunk_offsets(self):
+        return list(range(0, len(self.data), self.CHUNK_SIZE))
+
+    def status(self, upload_id):
+        response = self.client.get(f'/uploads/{upload_id}/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def complete(self, upload_id):
+        return self.client.post(f'/uploads/{upload_id}/complete/')
+
+    def expected_output(self):
+        """The output of a one-shot parse of the same statement"""
+        output_path = os.path.join(self.temp_dir, 'expected.csv')
+        rows = standardize_statement(self.statement_path, output_path)
+        with open(output_path, 'rb') as file:
+            return rows, file.read()
+
+    def test_init(self):
+        upload_id = self.init_upload()
+        status = self.status(upload_id)
+        self.assertEqual(status['size'], len(self.data))
+        self.assertEqual(status['received'], [])
+        self.assertEqual(status['contiguous'], 0)
+        self.assertFalse(status['complete'])
+
+    def test_init_rejects_other_files(self):
+        response = self.client.post('/uploads/', {'filename': 'statement.pdf', 'size': 10})
+        self.assertEqual(response.status_code, 400)
+
+    def test_out_of_order_and_retried_chunks(self):
+        upload_id = self.init_upload()
+        offsets = self.chunk_offsets()
+        for offset in reversed(offsets):
+            self.assertEqual(self.send_chunk(upload_id, offset).status_code, 200)
+        # A retried chunk is accepted and changes nothing
+        self.assertEqual(self.send_chunk(upload_id, offsets[1]).status_code, 200)
+
+        status = self.status(upload_id)
+        self.assertEqual(status['received'], [[0, len(self.data)]])
+        self.assertEqual(status['contiguous'], len(self.data))
+
+        rows, expected = self.expected_output()
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['rows_processed'], rows)
+        self.assertEqual(b''.join(self.client.get(response.json()['download_url']).streaming_content), expected)
+
+    def test_checksum_mismatch(self):
+        upload_id = self.init_upload()
+        response = self.send_chunk(upload_id, 0, checksum='0' * 64)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Checksum mismatch')
+        self.assertEqual(self.status(upload_id)['received'], [])
+
+    def test_status_and_resume(self):
+        upload_id = self.init_upload()
+        offsets = self.chunk_offsets()
+        half = len(offsets) // 2
+        for offset in offsets[:half] + offsets[-1:]:
+            self.send_chunk(upload_id, offset)
+
+        # The status tells the client what is missing
+        status = self.status(upload_id)
+        self.assertEqual(status['received'], [[0, offsets[half]], [offsets[-1], len(self.data)]])
+        self.assertEqual(status['contiguous'], offsets[half])
+        self.assertGreater(status['parsed'], 0)
+        self.assertFalse(status['done'])
+
+        # Completing too early is refused
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 400)
+
+        for offset in offsets[half:-1]:
+            self.send_chunk(upload_id, offset)
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.status(upload_id)['done'])
+
+    def test_complete_matches_standardize_statement(self):
+        upload_id = self.init_upload()
+        for offset in self.chunk_offsets():
+            self.assertEqual(self.send_chunk(upload_id, offset).status_code, 200)
+        # Everything but the end of the last record is parsed as it arrives
+        self.assertGreater(self.status(upload_id)['rows'], 0)
+
+        rows, expected = self.expected_output()
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result['rows_processed'], rows)
+        self.assertEqual(b''.join(self.client.get(result['download_url']).streaming_content), expected)
+
+        preview = self.client.get(result['preview_url'] + '?sections=1').json()
+        self.assertEqual(preview['total_rows'], rows)
+        self.assertTrue(preview['sections'])
+
+    def test_concurrent_chunks_share_one_output(self):
+        from . import views
+
+        # Slow down creating the output, as a busy disk would, to widen any race
+        create_output = views.create_output
+        patcher = mock.patch.object(views, 'create_output', lambda *args: time.sleep(0.05) or create_output(*args))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        upload_id = self.init_upload()
+        self.send_chunk(upload_id, 0)
+        # Retries of the chunk that makes the upload ready to parse, all at once
+        chunk = self.data[self.CHUNK_SIZE:2 * self.CHUNK_SIZE]
+        checksum = hashlib.sha256(chunk).hexdigest()
+        barrier = threading.Barrier(8)
+
+        def send():
+            barrier.wait()
+            views.store_chunk(upload_id, self.CHUNK_SIZE, chunk, checksum)
+        threads = [threading.Thread(target=send) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        store = artifacts.get_artifact_store()
+        outputs = [metadata['id'] for metadata in store.artifacts('output')]
+        self.assertEqual(outputs, [self.status(upload_id)['output_id']])
+
+    def test_tables_change_during_parse(self):
+        from . import views
+
+        # The shipped tables, and a version where DELHI rows get 'del' as their location
+        tables = {
+            'old': make_tables(self.temp_dir, 'old'),
+            'new': make_tables(self.temp_dir, 'new', common_cities=lambda cities: ['del'] + cities),
+        }
+
+        patchers = [mock.patch(f'normalizer.utils.{module}.get_reference_tables') for module in ('parser', 'chunked')]
+        for patcher in patchers:
+            patcher.start().return_value = tables['old']
+            self.addCleanup(patcher.stop)
+
+        def use_tables(name):
+            for patcher in patchers:
+                patcher.target.get_reference_tables.return_value = tables[name]
+
+        store = artifacts.get_artifact_store()
+        upload_id = chunked.init_upload(store, 'HDFC-statement.csv', len(self.data))
+        half = len(self.data) // 2
+        chunked.append_chunk(store, upload_id, 0, self.data[:half], hashlib.sha256(self.data[:half]).hexdigest())
+        chunked.start_parse(store, upload_id, views.reserve_output)
+        self.assertGreater(chunked.advance_parse(store.root, upload_id)['rows'], 0)
+
+        # New tables are swapped in before the rest arrives
+        use_tables('new')
+        chunked.append_chunk(store, upload_id, half, self.data[half:], hashlib.sha256(self.data[half:]).hexdigest())
+        chunked.mark_complete(store, upload_id)
+        status = chunked.finish_upload(store.root, upload_id)
+
+        rows, expected = self.expected_output()
+        self.assertEqual(status['rows'], rows)
+        with open_standardized(store.path(status['output_id'])) as file:
+            output = file.read()
+        self.assertEqual(output, expected.decode('utf-8-sig'))
+        self.assertIn(',del\r\n', output)
+        self.assertNotIn(',delhi\r\n', output)
+
+    def test_unknown_upload(self):
+        self.assertEqual(self.client.get('/uploads/' + '0' * 32 + '/').status_code, 404)
+        self.assertEqual(self.complete('0' * 32).status_code, 404)
+
+
+class BufferBlockTests(SimpleTestCase):
+    """
+    Splitting a buffer into rows in blocks, as chunked uploads are parsed
+    """
+
+    TEXT = 'Date,Narration\r\n01-02-2024,"Line one\nline two"\r\n02-02-2024,"A, ""quoted"" name"\r\n\r\n03-02-2024,é\r\n'
+
+    def expected_rows(self, text):
+        return list(csv.reader(io.StringIO(text, newline='')))
+
+    def test_blocks_match_csv_reader(self):
+        data = self.TEXT.encode('utf-8')
+        for block_size in (1, 7, 64, 1024):
+            blocks = iter_buffer_blocks(data, 0, len(data), 'utf-8', csv.excel, block_size=block_size)
+            self.assertEqual([row for rows, _ in blocks for row in rows], self.expected_rows(self.TEXT))
+
+    def test_incomplete_records_are_left_for_later(self):
+        data = self.TEXT.encode('utf-8')
+        rows, position = [], 0
+        # Cut inside the quoted line break and inside the last record
+        for end in (data.index(b'\nline'), data.index('é'.encode('utf-8')), len(data) - 1):
+            for block, next_position in iter_buffer_blocks(data, position, end, 'utf-8', csv.excel, final=False):
+                rows.extend(block)
+                position = next_position
+        for block, _ in iter_buffer_blocks(data, position, len(data), 'utf-8', csv.excel):
+            rows.extend(block)
+        self.assertEqual(rows, self.expected_rows(self.TEXT))
+
+    def test_utf8_bom(self):
+        data = codecs.BOM_UTF8 + self.TEXT.replace(',', ';').encode('utf-8')
+        encoding, data_start = sniff_encoding(data)
+        dialect = make_dialect(';')
+        # The BOM only starts the file, so a BOM'd file splits on bytes like any UTF-8 file
+        self.assertTrue(is_byte_splittable(encoding, dialect))
+        blocks = iter_buffer_blocks(data, data_start, len(data), encoding, dialect)
+        self.assertEqual([row for rows, _ in blocks for row in rows],
+                         list(csv.reader(io.StringIO(self.TEXT.replace(',', ';'), newline=''), dialect)))
+
+
+class ArtifactSweepTests(SimpleTestCase):
+    """
+    Sweeping the artifact store, as the processes sharing it see it
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='normalizer-tests-')
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        self.root = os.path.join(self.temp_dir, 'store')
+
+    def test_one_sweeper_per_store(self):
+        claim = ArtifactStore(self.root).claim_sweeper()
+        self.assertIsNotNone(claim)
+        self.addCleanup(claim.close)
+        # Another process (or store object) can't claim it while it is held
+        self.assertIsNone(ArtifactStore(self.root).claim_sweeper())
+        claim.close()
+        other = ArtifactStore(self.root).claim_sweeper()
+        self.assertIsNotNone(other)
+        other.close()
+
+    def test_stats_are_shared(self):
+        store = ArtifactStore(self.root, ttl=60)
+        old_id = store.create('old.csv', 'upload', content=io.BytesIO(b'a,b\n'))
+        kept_id = store.create('new.csv', 'upload', content=io.BytesIO(b'a,b\n'))
+        upload_id = store.create('chunked.csv', CHUNKED_UPLOAD_KIND, extra={'parse': None})
+        store.update_metadata(old_id, created=0)
+        store.update_metadata(upload_id, created=0)
+        with store.lock(upload_id):
+            store.sweep()
+
+        # Any store object on the same root, such as another worker's, reports the sweep
+        stats = ArtifactStore(self.root, ttl=60).stats()
+        self.assertEqual(stats['last_sweep']['expired'], 1)
+        self.assertEqual(stats['last_sweep']['in_use'], 1)
+        self.assertEqual(stats['totals']['sweeps'], 1)
+        self.assertEqual(sorted(metadata['id'] for metadata in store.artifacts()), sorted([kept_id, upload_id]))
+
+        # The upload is no longer locked, so the next sweep removes it and adds to the totals
+        ArtifactStore(self.root, ttl=60).sweep()
+        totals = store.stats()['totals']
+        self.assertEqual((totals['sweeps'], totals['expired']), (2, 2))
+
+
+class RenormalizeTests(SimpleTestCase):
+    """
+    Re-applying changed rules to stored outputs from their provenance
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='normalizer-tests-')
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        self.tables = {
+            'old': make_tables(self.temp_dir, 'old'),
+            # DELHI rows get 'del' as their location
+            'new': make_tables(self.temp_dir, 'new', common_cities=lambda cities: ['del'] + cities),
+            # A city no row mentions: the location rules change, their results don't
+            'unused': make_tables(self.temp_dir, 'unused', common_cities=lambda cities: cities + ['atlantis']),
+        }
+        self.patchers = [mock.patch(f'normalizer.utils.{module}.get_reference_tables')
+                         for module in ('parser', 'renormalize')]
+        for patcher in self.patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.use_tables('old')
+
+        self.statement_path = os.path.join(self.temp_dir, 'HDFC-statement.csv')
+        with open(self.statement_path, 'w', encoding='utf-8', newline='') as file:
+            file.write(generate_statement('hdfc', 100))
+        self.output_path = os.path.join(self.temp_dir, 'output.csv')
+        self.rows = standardize_statement(self.statement_path, self.output_path, 'gzip')
+
+    def use_tables(self, name):
+        for patcher in self.patchers:
+            patcher.target.get_reference_tables.return_value = self.tables[name]
+
+    def read_output(self, output_path=None):
+        with open_standardized(output_path or self.output_path) as file:
+            return list(csv.DictReader(file))
+
+    def expected_output(self, name):
+        """The output of parsing the statement again with one version of the tables"""
+        self.use_tables(name)
+        output_path = os.path.join(self.temp_dir, f'expected-{name}.csv')
+        standardize_statement(self.statement_path, output_path, 'gzip')
+        return self.read_output(output_path)
+
+    def test_outdated_families(self):
+        self.assertEqual(outdated_families(self.output_path), [])
+        self.use_tables('new')
+        self.assertEqual(outdated_families(self.output_path), ['location'])
+        self.assertEqual(outdated_families(self.output_path, families=['currency', 'name']), [])
+
+        # Outputs without provenance can't be re-normalized
+        os.remove(self.output_path + RULES_SUFFIX)
+        self.assertIsNone(outdated_families(self.output_path))
+        with self.assertRaises(ValueError):
+            renormalize_output(self.output_path)
+
+    def test_changed_columns(self):
+        before = self.read_output()
+        self.use_tables('new')
+        stats = renormalize_output(self.output_path)
+
+        after = self.read_output()
+        self.assertEqual(after, self.expected_output('new'))
+        delhi_rows = sum(1 for row in before if row['Location'] == 'delhi')
+        self.assertGreater(delhi_rows, 0)
+        self.assertEqual(stats['recomputed'], {'location': self.rows})
+        self.assertEqual(stats['changed'], {'Location': delhi_rows})
+        self.assertEqual(stats['changed_rows'], delhi_rows)
+        # Only the location column changed
+        for old_row, new_row in zip(before, after):
+            self.assertEqual(dict(old_row, Location=None), dict(new_row, Location=None))
+
+        self.assertEqual(read_rules_summary(self.output_path), [rule_fingerprints(self.tables['new'])])
+        self.assertEqual(RowIndex(self.output_path).read_rows(0, self.rows), after)
+        self.assertEqual(outdated_families(self.output_path), [])
+        # Nothing is left to do the second time
+        self.assertEqual(renormalize_output(self.output_path)['recomputed'], {})
+
+    def test_only_outdated_rows_are_recomputed(self):
+        # An output whose rows were produced partly before and partly after
+        # a change of the tables
+        with StatementFile(self.statement_path) as statement:
+            lines = list(statement.rows())
+        switch_at = len(lines) // 2
+        with IndexedCsvWriter(self.output_path, OUTPUT_FIELDS, compression='gzip') as writer:
+            with ProvenanceWriter(self.output_path) as recorder:
+                recorder.start('hdfc', ',')
+                parser = StatementRowParser('hdfc', tables=self.tables['old'])
+                recorder.set_rules(rule_fingerprints(self.tables['old']))
+                old_rows = 0
+                for number, line in enumerate(lines):
+                    if number == switch_at:
+                        state = dict(parser.get_state(), tables_version=self.tables['new'].version)
+                        parser = StatementRowParser.from_state(state, self.tables['new'])
+                        recorder.set_rules(rule_fingerprints(self.tables['new']))
+                    row = parser.feed(line)
+                    if row:
+                        writer.writerow(row)
+                        old_rows += number < switch_at
+                    recorder.record(line, row)
+        self.assertEqual(len(read_rules_summary(self.output_path)), 2)
+
+        self.use_tables('new')
+        stats = renormalize_output(self.output_path)
+        self.assertEqual(stats['recomputed'], {'location': old_rows})
+        self.assertEqual(self.read_output(), self.expected_output('new'))
+        self.assertEqual(read_rules_summary(self.output_path), [rule_fingerprints(self.tables['new'])])
+
+    def test_no_change_leaves_output_alone(self):
+        output_stat = os.stat(self.output_path)
+        index_stat = os.stat(self.output_path + INDEX_SUFFIX)
+        self.use_tables('unused')
+        self.assertEqual(outdated_families(self.output_path), ['location'])
+
+        stats = renormalize_output(self.output_path)
+        self.assertEqual(stats['recomputed'], {'location': self.rows})
+        self.assertEqual(stats['changed_rows'], 0)
+        # The output and its index are the same files; only the fingerprints moved on
+        for suffix, old_stat in (('', output_stat), (INDEX_SUFFIX, index_stat)):
+            new_stat = os.stat(self.output_path + suffix)
+            self.assertEqual((new_stat.st_ino, new_stat.st_mtime_ns), (old_stat.st_ino, old_stat.st_mtime_ns))
+        self.assertEqual(read_rules_summary(self.output_path), [rule_fingerprints(self.tables['unused'])])
+        self.assertEqual(outdated_families(self.output_path), [])
+        self.assertFalse([name for name in os.listdir(self.temp_dir) if RENORMALIZING_SUFFIX in name])
+
+    def test_swap_waits_for_readers(self):
+        store = ArtifactStore(os.path.join(self.temp_dir, 'store'))
+        output_id = store.create('output.csv', 'output', extra={'compression': 'gzip'})
+        output_path = store.path(output_id)
+        standardize_statement(self.statement_path, output_path, 'gzip')
+        before = self.read_output(output_path)
+
+        self.use_tables('new')
+        result = {}
+        renormalizing = threading.Thread(target=lambda: result.update(
+            renormalize_output(output_path, swap_lock=store.lock(output_id))))
+        # A download or preview holds the shared lock while it opens the output
+        with store.lock(output_id, shared=True):
+            renormalizing.start()
+            renormalizing.join(timeout=1)
+            self.assertTrue(renormalizing.is_alive())
+            self.assertEqual(self.read_output(output_path), before)
+            self.assertEqual(RowIndex(output_path).read_rows(0, self.rows), before)
+        renormalizing.join()
+
+        self.assertGreater(result['changed_rows'], 0)
+        self.assertEqual(self.read_output(output_path), self.expected_output('new'))
+        self.assertEqual(read_rules_summary(output_path), [rule_fingerprints(self.tables['new'])])
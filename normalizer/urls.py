@@ -4,5 +4,11 @@ from . import views
 urlpatterns = [
     path('', views.home, name='home'),
     path('upload/', views.upload_file, name='upload_file'),
-    path('download/<str:filename>/', views.download_file, name='download_file'),
+    path('download/<str:artifact_id>/', views.download_file, name='download_file'),
+    path('preview/<str:artifact_id>/', views.preview_file, name='preview_file'),
+    path('uploads/', views.chunked_upload_init, name='chunked_upload_init'),
+    path('uploads/<str:upload_id>/', views.chunked_upload_status, name='chunked_upload_status'),
+    path('uploads/<str:upload_id>/chunks/', views.chunked_upload_append, name='chunked_upload_append'),
+    path('uploads/<str:upload_id>/complete/', views.chunked_upload_complete, name='chunked_upload_complete'),
+    path('status/', views.parse_status, name='parse_status'),
 ] 
\ No newline at end of file
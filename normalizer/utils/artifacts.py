@@ -0,0 +1,403 @@
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows; fine for the single-process development server
+    fcntl = None
+
+from django.conf import settings
+
+METADATA_FILENAME = 'meta.json'
+LOCK_FILENAME = '.lock'
+
+# Store-level files: the statistics of the sweeps, the lock held while one
+# runs, and the lock held by the one process whose thread sweeps the store
+SWEEP_STATS_FILENAME = 'sweep.json'
+SWEEP_LOCK_FILENAME = '.sweep.lock'
+SWEEPER_LOCK_FILENAME = '.sweeper.lock'
+
+ARTIFACT_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# Artifact kind of an upload that is still being assembled from chunks
+CHUNKED_UPLOAD_KIND = 'chunked-upload'
+
+
+class ArtifactNotFound(Exception):
+    """Raised when an artifact id is unknown, malformed or already evicted"""
+
+
+def safe_filename(name):
+    """
+    Reduces a user supplied filename to something safe to store on disk
+    """
+    name = os.path.basename(name.replace('\\', '/'))
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', name).lstrip('.')
+    return name[:150] or 'file'
+
+
+class ArtifactStore:
+    """
+    Stores uploads and outputs under hash-sharded directories
+
+    Every artifact gets a random 32 character hex id and lives in
+    <root>/<id[0:2]>/<id[2:4]>/<id>/ next to a small metadata file, so no
+    directory grows past a few hundred entries and a lookup is a couple of
+    path joins regardless of how many artifacts exist. sweep() removes
+    artifacts older than `ttl` seconds, then the oldest ones until the store
+    fits in `max_bytes`. Artifacts that are locked (see lock()) are never
+    removed, and chunked uploads that are still being received or parsed,
+    with their outputs, are never evicted for the quota. Sweep statistics
+    are kept in the store, so every process reports the same ones.
+    """
+
+    def __init__(self, root, ttl=None, max_bytes=None):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def _directory(self, artifact_id):
+        if not ARTIFACT_ID_PATTERN.match(artifact_id or ''):
+            raise ArtifactNotFound(artifact_id)
+        return os.path.join(self.root, artifact_id[0:2], artifact_id[2:4], artifact_id)
+
+    def create(self, name, kind, content=None, extra=None):
+        """
+        Creates a new artifact and returns its id
+        `content` may be a Django File (or any file-like object) to copy in;
+        otherwise the caller writes the file at path(id) itself
+        """
+        artifact_id = uuid.uuid4().hex
+        directory = self._directory(artifact_id)
+        os.makedirs(directory)
+
+        filename = safe_filename(name)
+        metadata = {
+            'id': artifact_id,
+            'name': name,
+            'filename': filename,
+            'kind': kind,
+            'created': time.time(),
+        }
+        if extra:
+            metadata.update(extra)
+        self._write_metadata(directory, metadata)
+
+        if content is not None:
+            with open(os.path.join(directory, filename), 'wb') as destination:
+                if hasattr(content, 'chunks'):
+                    for chunk in content.chunks():
+                        destination.write(chunk)
+                else:
+                    shutil.copyfileobj(content, destination)
+        return artifact_id
+
+    def _write_metadata(self, directory, metadata):
+        # Write then rename so readers never see a half written file
+        temp_path = os.path.join(directory, METADATA_FILENAME + '.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(metadata, file)
+        os.replace(temp_path, os.path.join(directory, METADATA_FILENAME))
+
+    def metadata(self, artifact_id):
+        """Returns the metadata dict of an artifact"""
+        try:
+            with open(os.path.join(self._directory(artifact_id), METADATA_FILENAME), encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            raise ArtifactNotFound(artifact_id)
+
+    def update_metadata(self, artifact_id, **values):
+        """Adds or replaces metadata values of an artifact"""
+        metadata = self.metadata(artifact_id)
+        metadata.update(values)
+        self._write_metadata(self._directory(artifact_id), metadata)
+        return metadata
+
+    @contextmanager
+    def lock(self, artifact_id, shared=False):
+        """
+        Holds an exclusive lock on an artifact, across threads and processes
+        Use it around read-modify-write updates of an artifact's metadata, or
+        around replacing its files. Readers that open several of an
+        artifact's files take a shared lock so they see them all from before
+        or all from after such a change.
+        """
+        try:
+            file = open(os.path.join(self._directory(artifact_id), LOCK_FILENAME), 'a')
+        except FileNotFoundError:
+            raise ArtifactNotFound(artifact_id)
+        with file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+
+    def path(self, artifact_id, metadata=None):
+        """Returns the path of the artifact's data file"""
+        if metadata is None:
+            metadata = self.metadata(artifact_id)
+        return os.path.join(self._directory(artifact_id), metadata['filename'])
+
+    def sibling_path(self, artifact_id, suffix):
+        """Returns a path next to the data file for derived files such as indexes"""
+        return self.path(artifact_id) + suffix
+
+    def delete(self, artifact_id):
+        """Removes an artifact; returns the number of bytes freed"""
+        directory = self._directory(artifact_id)
+        freed = _directory_size(directory)
+        shutil.rmtree(directory, ignore_errors=True)
+        return freed
+
+    def delete_if_unlocked(self, artifact_id):
+        """
+        Removes an artifact unless someone holds its lock
+        Returns the number of bytes freed, or None if it is in use
+        """
+        try:
+            file = open(os.path.join(self._directory(artifact_id), LOCK_FILENAME), 'a')
+        except FileNotFoundError:
+            return self.delete(artifact_id)  # Half created or half deleted
+        with file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None
+            return self.delete(artifact_id)
+
+    def _iter_directories(self):
+        """Yields the directory entry of every artifact in the store"""
+        if not os.path.isdir(self.root):
+            return
+        for first in os.scandir(self.root):
+            if not (first.is_dir() and len(first.name) == 2):
+                continue
+            for second in os.scandir(first.path):
+                if not second.is_dir():
+                    continue
+                for entry in os.scandir(second.path):
+                    if ARTIFACT_ID_PATTERN.match(entry.name):
+                        yield entry
+
+    def _iter_artifacts(self):
+        """
+        Yields (created, size, artifact_id, metadata) for every artifact in
+        the store; metadata is None if it can't be read
+        """
+        for entry in self._iter_directories():
+            try:
+                metadata = self.metadata(entry.name)
+                created = metadata['created']
+            except ArtifactNotFound:
+                # Half created or half deleted; judge it by its mtime
+                metadata = None
+                created = entry.stat().st_mtime
+            yield created, _directory_size(entry.path), entry.name, metadata
+
+    def artifacts(self, kind=None):
+        """
+        Yields the metadata of every artifact, or of those of one kind
+        Artifacts without readable metadata are skipped
+        """
+        for entry in self._iter_directories():
+            try:
+                metadata = self.metadata(entry.name)
+            except ArtifactNotFound:
+                continue
+            if kind is None or metadata['kind'] == kind:
+                yield metadata
+
+    @contextmanager
+    def _sweep_lock(self):
+        """Holds the store's sweep lock, so sweeps by different processes never overlap"""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, SWEEP_LOCK_FILENAME), 'a') as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+
+    def claim_sweeper(self):
+        """
+        Tries to become the one process that sweeps this store in the
+        background. Returns the lock file to keep open while it does, or None
+        if another process holds it.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        file = open(os.path.join(self.root, SWEEPER_LOCK_FILENAME), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                return None
+        return file
+
+    def sweep(self, now=None):
+        """
+        Removes expired artifacts, then the oldest ones until the store is
+        under its size quota. Returns the statistics of this sweep.
+        """
+        with self._sweep_lock():
+            now = time.time() if now is None else now
+            started = time.time()
+            stats = {'scanned': 0, 'expired': 0, 'evicted': 0, 'in_use': 0, 'bytes_freed': 0,
+                     'bytes_remaining': 0}
+
+            kept = []
+            in_progress = set()
+            for created, size, artifact_id, metadata in self._iter_artifacts():
+                stats['scanned'] += 1
+                if self.ttl and now - created > self.ttl:
+                    freed = self.delete_if_unlocked(artifact_id)
+                    if freed is not None:
+                        stats['bytes_freed'] += freed
+                        stats['expired'] += 1
+                        continue
+                    stats['in_use'] += 1
+                kept.append((created, size, artifact_id))
+                if metadata is not None and _in_progress(metadata):
+                    in_progress.add(artifact_id)
+                    in_progress.add((metadata['parse'] or {}).get('output_id'))
+
+            total = sum(size for _, size, _ in kept)
+            if self.max_bytes and total > self.max_bytes:
+                kept.sort()
+                for created, size, artifact_id in kept:
+                    if total <= self.max_bytes:
+                        break
+                    if artifact_id in in_progress:
+                        continue
+                    freed = self.delete_if_unlocked(artifact_id)
+                    if freed is None:
+                        stats['in_use'] += 1
+                        continue
+                    stats['bytes_freed'] += freed
+                    stats['evicted'] += 1
+                    total -= size
+            stats['bytes_remaining'] = total
+
+            self._remove_empty_shards()
+            stats['duration'] = round(time.time() - started, 3)
+            stats['finished'] = time.time()
+            stats['pid'] = os.getpid()
+
+            recorded = self._read_sweep_stats()
+            recorded['last_sweep'] = stats
+            recorded['totals']['sweeps'] += 1
+            for key in ('expired', 'evicted', 'bytes_freed'):
+                recorded['totals'][key] += stats[key]
+            # Write then rename so readers never see a half written file
+            temp_path = os.path.join(self.root, SWEEP_STATS_FILENAME + '.tmp')
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(recorded, file)
+            os.replace(temp_path, os.path.join(self.root, SWEEP_STATS_FILENAME))
+            return stats
+
+    def _read_sweep_stats(self):
+        try:
+            with open(os.path.join(self.root, SWEEP_STATS_FILENAME), encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {'last_sweep': None, 'totals': {'sweeps': 0, 'expired': 0, 'evicted': 0, 'bytes_freed': 0}}
+
+    def _remove_empty_shards(self):
+        if not os.path.isdir(self.root):
+            return
+        for first in os.scandir(self.root):
+            if not (first.is_dir() and len(first.name) == 2):
+                continue
+            for second in os.scandir(first.path):
+                if second.is_dir():
+                    _remove_if_empty(second.path)
+            _remove_if_empty(first.path)
+
+    def stats(self):
+        """Returns eviction statistics of the sweeps of this store, by any process"""
+        recorded = self._read_sweep_stats()
+        return {
+            'ttl': self.ttl,
+            'max_bytes': self.max_bytes,
+            'last_sweep': recorded['last_sweep'],
+            'totals': recorded['totals'],
+        }
+
+
+def _in_progress(metadata):
+    """Whether an artifact is a chunked upload that is still being received or parsed"""
+    parse = metadata.get('parse') or {}
+    return metadata['kind'] == CHUNKED_UPLOAD_KIND and not parse.get('done')
+
+
+def _directory_size(path):
+    size = 0
+    try:
+        for entry in os.scandir(path):
+            if entry.is_file(follow_symlinks=False):
+                size += entry.stat(follow_symlinks=False).st_size
+    except FileNotFoundError:
+        pass
+    return size
+
+
+def _remove_if_empty(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+def _run_sweeper(store, interval):
+    # Every web process runs this thread, but only the one that claimed the
+    # store sweeps it; the others try again every round, so one of them
+    # takes over when that process exits
+    claim = None
+    while True:
+        time.sleep(interval)
+        try:
+            if claim is None:
+                claim = store.claim_sweeper()
+            if claim is not None:
+                store.sweep()
+        except Exception:
+            # Keep sweeping on the next round; a failed sweep only delays eviction
+            pass
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_artifact_store():
+    """
+    Returns the process-wide ArtifactStore, configured from settings
+    Starts the background sweeper thread on first use; of all the processes
+    using the store, one sweeps it (see _run_sweeper)
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ArtifactStore(
+                getattr(settings, 'ARTIFACT_ROOT', settings.MEDIA_ROOT),
+                ttl=getattr(settings, 'ARTIFACT_TTL', None),
+                max_bytes=getattr(settings, 'ARTIFACT_MAX_BYTES', None),
+            )
+            interval = getattr(settings, 'ARTIFACT_SWEEP_INTERVAL', 0)
+            if interval:
+                threading.Thread(target=_run_sweeper, args=(_store, interval),
+                                 name='artifact-sweeper', daemon=True).start()
+        return _store
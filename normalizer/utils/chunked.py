@@ -0,0 +1,245 @@
+import hashlib
+import mmap
+
+from .artifacts import CHUNKED_UPLOAD_KIND, ArtifactStore
+from .parser import (StatementRowParser, STATEMENT_FORMATS, OUTPUT_FIELDS, detect_bank_format,
+                     standardize_statement, rule_fingerprints)
+from .provenance import ProvenanceWriter
+from .reftables import get_reference_tables
+from .compression import detect_compression
+from .reader import (SNIFF_SAMPLE_SIZE, sniff_encoding, sniff_dialect, make_dialect, is_byte_splittable,
+                     iter_buffer_blocks)
+from .rowindex import ResumableCsvWriter
+
+class ChunkError(Exception):
+    """Raised when a chunk can't be accepted (bad checksum, offset or state)"""
+
+
+def init_upload(store, name, size=None):
+    """
+    Starts a chunked upload and returns its id
+    `size` is the total size in bytes if the client knows it
+    """
+    if size is not None and size < 0:
+        raise ChunkError('Size must not be negative')
+    upload_id = store.create(name, CHUNKED_UPLOAD_KIND, extra={
+        'size': size,
+        'received': [],
+        'contiguous': 0,
+        'complete': False,
+        'parse': None,
+    })
+    # The assembly file; chunks are written into it at their offsets
+    open(store.path(upload_id), 'wb').close()
+    return upload_id
+
+
+def upload_status(store, upload_id, metadata=None):
+    """Returns what the client needs to resume or follow an upload"""
+    if metadata is None:
+        metadata = store.metadata(upload_id)
+    if metadata['kind'] != CHUNKED_UPLOAD_KIND:
+        raise ChunkError('Not a chunked upload')
+    parse = metadata['parse'] or {}
+    return {
+        'upload_id': upload_id,
+        'name': metadata['name'],
+        'size': metadata['size'],
+        'received': metadata['received'],
+        'contiguous': metadata['contiguous'],
+        'complete': metadata['complete'],
+        'parsed': parse.get('offset', 0),
+        'rows': parse.get('rows', 0),
+        'done': parse.get('done', False),
+        'output_id': parse.get('output_id'),
+    }
+
+
+def _merge_range(ranges, start, end):
+    """Adds [start, end) to a sorted list of disjoint [start, end] ranges"""
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+
+def append_chunk(store, upload_id, offset, data, checksum):
+    """
+    Writes a chunk at `offset` after checking its SHA-256 checksum
+    Chunks may arrive out of order or more than once. Returns the upload status.
+    """
+    if hashlib.sha256(data).hexdigest() != (checksum or '').lower():
+        raise ChunkError('Checksum mismatch')
+
+    with store.lock(upload_id):
+        metadata = store.metadata(upload_id)
+        if metadata['kind'] != CHUNKED_UPLOAD_KIND:
+            raise ChunkError('Not a chunked upload')
+        if metadata['complete']:
+            raise ChunkError('Upload is already complete')
+        if offset < 0 or (metadata['size'] is not None and offset + len(data) > metadata['size']):
+            raise ChunkError('Chunk is outside the declared size')
+
+        if data:
+            with open(store.path(upload_id, metadata), 'r+b') as file:
+                file.seek(offset)
+                file.write(data)
+            metadata['received'] = _merge_range(metadata['received'], offset, offset + len(data))
+            first = metadata['received'][0]
+            metadata['contiguous'] = first[1] if first[0] == 0 else 0
+            store.update_metadata(upload_id, received=metadata['received'], contiguous=metadata['contiguous'])
+        return upload_status(store, upload_id, metadata)
+
+
+def mark_complete(store, upload_id):
+    """
+    Checks that every byte has arrived and closes the upload to new chunks
+    """
+    with store.lock(upload_id):
+        metadata = store.metadata(upload_id)
+        if metadata['kind'] != CHUNKED_UPLOAD_KIND:
+            raise ChunkError('Not a chunked upload')
+        size = metadata['size'] if metadata['size'] is not None else metadata['contiguous']
+        if len(metadata['received']) > 1 or metadata['contiguous'] != size:
+            raise ChunkError(f"Missing data: {metadata['contiguous']} of {size} bytes received in order")
+        metadata = store.update_metadata(upload_id, complete=True, size=size)
+        return upload_status(store, upload_id, metadata)
+
+
+def ready_to_parse(metadata):
+    """
+    Whether enough of the start of the file has arrived to detect its
+    encoding, delimiter and bank, and parsing hasn't been set up yet
+    """
+    return metadata['parse'] is None and (metadata['complete'] or metadata['contiguous'] >= SNIFF_SAMPLE_SIZE)
+
+
+def start_parse(store, upload_id, reserve_output):
+    """
+    Sets up incremental parsing of an upload once it is ready to parse
+    Statements that can't be parsed incrementally (unknown bank, compressed
+    uploads, or an encoding that can't be split on bytes) are parsed in full
+    on completion. `reserve_output(upload_id)` creates the output artifact
+    and returns its (output_id, compression); it is only called once per
+    upload, under the upload's lock, so concurrent calls share one output.
+    Returns the parse state, or None if the upload isn't ready yet.
+    """
+    with store.lock(upload_id):
+        metadata = store.metadata(upload_id)
+        if metadata['parse'] is not None:
+            return metadata['parse']
+        if not ready_to_parse(metadata):
+            return None
+        output_id, compression = reserve_output(upload_id)
+        data_path = store.path(upload_id, metadata)
+
+        with open(data_path, 'rb') as file:
+            sample = file.read(min(metadata['contiguous'], SNIFF_SAMPLE_SIZE))
+        encoding, data_start = sniff_encoding(sample)
+        dialect = sniff_dialect(sample.decode(encoding, errors='ignore'))
+        bank_format = detect_bank_format(data_path)
+
+        parse = {'output_id': output_id, 'offset': 0, 'compression': compression}
+        if (detect_compression(sample) or bank_format not in STATEMENT_FORMATS
+                or not is_byte_splittable(encoding, dialect)):
+            parse['deferred'] = True
+        else:
+            parse.update({
+                'offset': data_start,
+                'data_start': data_start,
+                'encoding': encoding,
+                'delimiter': dialect.delimiter,
+                'parser': StatementRowParser(bank_format, dialect.delimiter).get_state(),
+                'writer': None,
+            })
+        store.update_metadata(upload_id, parse=parse)
+        return parse
+
+
+def advance_parse(root, upload_id, final=False):
+    """
+    Parses the records that have arrived since the last call and appends
+    their rows to the output. With final=True the rest of the file is parsed
+    and the output's row index is written. Returns the upload status.
+
+    Only takes plain arguments so that it can run in the parse process pool.
+    """
+    store = ArtifactStore(root)
+    with store.lock(upload_id):
+        metadata = store.metadata(upload_id)
+        parse = metadata['parse']
+        if parse is None or parse.get('deferred') or parse.get('done'):
+            return upload_status(store, upload_id, metadata)
+
+        end = metadata['contiguous']
+        output_path = store.path(parse['output_id'])
+        tables = get_reference_tables()
+        if parse['parser']['tables_version'] != tables.version:
+            # The reference tables changed since the parse started; parse what
+            # has arrived again with the new ones, so the whole output comes
+            # from one version of them (new writers start the files afresh)
+            parse.update(offset=parse['data_start'], writer=None, provenance=None,
+                         parser=StatementRowParser(parse['parser']['bank_format'], parse['delimiter'],
+                                                   tables).get_state())
+        parser = StatementRowParser.from_state(parse['parser'], tables)
+        dialect = make_dialect(parse['delimiter'])
+        position = parse['offset']
+
+        writer = ResumableCsvWriter(output_path, OUTPUT_FIELDS, parse['writer'], compression=parse['compression'])
+        recorder = ProvenanceWriter(output_path, parse.get('provenance'), final=final)
+        with writer, recorder:
+            if parse.get('provenance') is None:
+                recorder.start(parser.bank_format, parse['delimiter'])
+            recorder.set_rules(rule_fingerprints(parser.tables))
+            if end > position:
+                with open(store.path(upload_id, metadata), 'rb') as file:
+                    data = mmap.mmap(file.fileno(), end, access=mmap.ACCESS_READ)
+                    try:
+                        for lines, next_position in iter_buffer_blocks(data, position, end, parse['encoding'],
+                                                                       dialect, final=final):
+                            for line in lines:
+                                row = parser.feed(line)
+                                if row:
+                                    writer.writerow(row)
+                                recorder.record(line, row)
+                            position = next_position
+                    finally:
+                        data.close()
+
+        parse.update(offset=position, parser=parser.get_state(), writer=writer.get_state(),
+                     provenance=recorder.get_state(), rows=writer.get_state()['rows'])
+        if final:
+            ResumableCsvWriter.finish(output_path, parse['writer'])
+            parse['done'] = True
+        metadata = store.update_metadata(upload_id, parse=parse)
+        return upload_status(store, upload_id, metadata)
+
+
+def finish_deferred(root, upload_id):
+    """
+    Parses a completed upload that couldn't be parsed incrementally
+    """
+    store = ArtifactStore(root)
+    with store.lock(upload_id):
+        metadata = store.metadata(upload_id)
+        parse = metadata['parse']
+        if not parse.get('done'):
+            rows = standardize_statement(store.path(upload_id, metadata), store.path(parse['output_id']),
+                                         parse['compression'])
+            parse.update(rows=rows, done=True)
+            metadata = store.update_metadata(upload_id, parse=parse)
+        return upload_status(store, upload_id, metadata)
+
+
+def finish_upload(root, upload_id):
+    """
+    Finishes parsing a completed upload, incrementally or in one go
+    Only takes plain arguments so that it can run in the parse process pool.
+    """
+    metadata = ArtifactStore(root).metadata(upload_id)
+    if metadata['parse'].get('deferred'):
+        return finish_deferred(root, upload_id)
+    return advance_parse(root, upload_id, final=True)
@@ -0,0 +1,188 @@
+import gzip
+import struct
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Uncompressed bytes between the points where a compressed output can be
+# entered for random access; smaller blocks mean cheaper previews but a
+# slightly worse compression ratio
+SEEK_BLOCK_SIZE = 64 * 1024
+
+# How much compressed data is read at a time when decompressing a range
+READ_SIZE = 16 * 1024
+
+
+def supported_suffixes():
+    """Returns the upload filename suffixes the parser can read"""
+    suffixes = ['.csv', '.csv.gz']
+    if zstandard is not None:
+        suffixes.append('.csv.zst')
+    return tuple(suffixes)
+
+
+def is_supported_upload(filename):
+    """
+    Checks if an uploaded file is a CSV statement, plain or compressed
+    """
+    return filename.lower().endswith(supported_suffixes())
+
+
+def detect_compression(sample):
+    """
+    Detects compressed data from its first bytes
+    Returns 'gzip', 'zstd' or None
+    """
+    if sample.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if sample.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def open_decompressed(file_path, compression):
+    """
+    Opens a compressed file as a binary stream of its decompressed content
+    Data is decompressed as it is read; nothing is written to disk
+    """
+    if compression == 'gzip':
+        return gzip.open(file_path, 'rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compressed statements need the zstandard package')
+        return zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+    return open(file_path, 'rb')
+
+
+def iter_chunks(file, chunk_size=READ_SIZE):
+    """
+    Yields the content of an open binary file a chunk at a time and closes
+    the file once it is exhausted (or the generator is closed)
+    """
+    with file:
+        yield from iter(lambda: file.read(chunk_size), b'')
+
+
+def iter_gunzipped(file, chunk_size=READ_SIZE):
+    """
+    Yields the decompressed content of an open gzip file a chunk at a time
+    and closes the file once it is exhausted (or the generator is closed)
+    """
+    with file, gzip.GzipFile(fileobj=file, mode='rb') as decompressed:
+        yield from iter(lambda: decompressed.read(chunk_size), b'')
+
+
+class SeekableGzipWriter:
+    """
+    Writes a gzip file that can be read from the middle
+
+    The deflate stream is fully flushed every SEEK_BLOCK_SIZE bytes, which
+    byte-aligns it and resets the compression history, so decompression can
+    start at any of those points. `blocks` lists them as
+    [uncompressed offset, compressed offset] pairs. The result is still a
+    single ordinary gzip member that any gzip reader or browser accepts.
+
+    A writer can be closed and resumed later from get_state(); finish()
+    writes the gzip trailer. A resumed writer's `blocks` only holds the seek
+    points added since, so the state stays the same size however long the
+    file grows; keeping the earlier ones is up to the caller.
+    """
+
+    def __init__(self, file, state=None, level=6, block_size=SEEK_BLOCK_SIZE):
+        self._file = file
+        self._level = level
+        self._block_size = block_size
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        if state is None:
+            # Minimal gzip header: no name, no extra fields, unknown OS
+            header = GZIP_MAGIC + struct.pack('<BBIBB', 8, 0, int(time.time()), 0, 255)
+            self._file.write(header)
+            self.crc = 0
+            self.size = 0
+            self.compressed = len(header)
+            self.blocks = [[0, self.compressed]]
+        else:
+            self.crc = state['crc']
+            self.size = state['size']
+            self.compressed = state['compressed']
+            self.blocks = []
+        self._pending = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self._pending += len(data)
+        self._emit(self._compressor.compress(data))
+        if self._pending >= self._block_size:
+            self.flush_block()
+
+    def _emit(self, data):
+        if data:
+            self._file.write(data)
+            self.compressed += len(data)
+
+    def flush_block(self):
+        """Ends the current block so the data after it can be read on its own"""
+        if self._pending:
+            self._emit(self._compressor.flush(zlib.Z_FULL_FLUSH))
+            self.blocks.append([self.size, self.compressed])
+            self._pending = 0
+
+    def get_state(self):
+        """Flushes the current block and returns what a later session needs to carry on"""
+        self.flush_block()
+        return {'crc': self.crc, 'size': self.size, 'compressed': self.compressed}
+
+    def finish(self):
+        """Ends the deflate stream and writes the gzip trailer"""
+        self.flush_block()
+        self._emit(self._compressor.flush(zlib.Z_FINISH))
+        self._emit(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        # The final block is empty, so it never needs to be a seek point
+        if self.blocks and self.blocks[-1][0] == self.size and self.size:
+            self.blocks.pop()
+
+
+def read_gzip_range(file, blocks, start, end):
+    """
+    Returns bytes start..end of the uncompressed content of a file written
+    by SeekableGzipWriter, decompressing only from the nearest block
+    `blocks` only needs len() and indexing, so it can be read from disk
+    one entry at a time (see rowindex.BlockTable).
+    """
+    if end <= start:
+        return b''
+    # Last block that starts at or before `start`
+    low, high = 0, len(blocks)
+    while low < high:
+        middle = (low + high) // 2
+        if blocks[middle][0] <= start:
+            low = middle + 1
+        else:
+            high = middle
+    block_start, compressed_start = blocks[max(low - 1, 0)]
+
+    file.seek(compressed_start)
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    skip = start - block_start
+    wanted = end - start
+    parts = []
+    while wanted > 0 and not decompressor.eof:
+        compressed = file.read(READ_SIZE)
+        if not compressed:
+            break
+        data = decompressor.decompress(compressed)
+        if skip:
+            dropped = min(skip, len(data))
+            data = data[dropped:]
+            skip -= dropped
+        parts.append(data[:wanted])
+        wanted -= len(parts[-1])
+    return b''.join(parts)
@@ -0,0 +1,122 @@
+import csv
+import heapq
+import os
+import tempfile
+
+from .parser import OUTPUT_FIELDS
+from .rowindex import open_standardized
+
+# Default amount of memory used to hold rows while sorting a run
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Rough per-row overhead of a list of strings on top of the text itself
+ROW_OVERHEAD = 400
+
+# Maximum number of runs merged at once, to stay well under open file limits
+MAX_MERGE_FANIN = 64
+
+
+def date_sort_key(date_str):
+    """
+    Converts a DD-MM-YYYY date into a sortable YYYYMMDD integer
+    Rows without a valid date sort after everything else
+    """
+    try:
+        day, month, year = date_str.strip().split('-')
+        return int(year) * 10000 + int(month) * 100 + int(day)
+    except ValueError:
+        return 99999999
+
+
+def read_normalized_rows(file_path):
+    """
+    Yields the data rows of a standardized output file, in file order
+    """
+    with open_standardized(file_path) as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:
+            return
+        # Map columns by name in case an output has them in another order
+        positions = [header.index(field) if field in header else None for field in OUTPUT_FIELDS]
+        for line in reader:
+            if not line:
+                continue
+            yield [line[i] if i is not None and i < len(line) else '' for i in positions]
+
+
+def _write_run(rows, run_dir, run_number):
+    """Sorts a batch of keyed rows and writes it out as a run file"""
+    rows.sort(key=lambda row: row[:3])
+    run_path = os.path.join(run_dir, f'run-{run_number:06d}.csv')
+    with open(run_path, 'w', newline='', encoding='utf-8') as file:
+        csv.writer(file).writerows(rows)
+    return run_path
+
+
+def _read_run(run_path):
+    """Yields the keyed rows of a run file with their keys as integers"""
+    with open(run_path, 'r', newline='', encoding='utf-8') as file:
+        for line in csv.reader(file):
+            line[0] = int(line[0])
+            line[1] = int(line[1])
+            line[2] = int(line[2])
+            yield line
+
+
+def _merge_runs(run_paths, run_dir, run_number):
+    """Merges several runs into a single new run file"""
+    merged_path = os.path.join(run_dir, f'run-{run_number:06d}.csv')
+    with open(merged_path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerows(heapq.merge(*[_read_run(path) for path in run_paths], key=lambda row: row[:3]))
+    for path in run_paths:
+        os.remove(path)
+    return merged_path
+
+
+def merge_statements(input_files, output_file, memory_budget=DEFAULT_MEMORY_BUDGET, temp_dir=None):
+    """
+    Merges any number of standardized outputs into one date-ordered ledger
+
+    Rows are collected into sorted runs of at most `memory_budget` bytes,
+    which are spilled to temporary files and then k-way merged. Rows on the
+    same date keep the order of `input_files` and, within a file, their
+    original order, so the same inputs always give the same ledger.
+    Returns the number of rows written.
+    """
+    with tempfile.TemporaryDirectory(prefix='ledger-', dir=temp_dir) as run_dir:
+        runs = []
+        batch = []
+        batch_size = 0
+
+        # Split the inputs into sorted runs
+        for source_index, input_file in enumerate(input_files):
+            for row_number, row in enumerate(read_normalized_rows(input_file)):
+                batch.append([date_sort_key(row[0]), source_index, row_number] + row)
+                batch_size += ROW_OVERHEAD + sum(len(field) for field in row)
+                if batch_size >= memory_budget:
+                    runs.append(_write_run(batch, run_dir, len(runs)))
+                    batch = []
+                    batch_size = 0
+
+        # The last batch never needs to touch the disk
+        batch.sort(key=lambda row: row[:3])
+
+        # Reduce the number of runs until they can all be merged at once
+        run_number = len(runs)
+        while len(runs) + 1 > MAX_MERGE_FANIN:
+            group, runs = runs[:MAX_MERGE_FANIN], runs[MAX_MERGE_FANIN:]
+            runs.append(_merge_runs(group, run_dir, run_number))
+            run_number += 1
+
+        # Final merge straight into the ledger
+        count = 0
+        with open(output_file, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(OUTPUT_FIELDS)
+            for row in heapq.merge(batch, *[_read_run(path) for path in runs], key=lambda row: row[:3]):
+                writer.writerow(row[3:])
+                count += 1
+
+    return count
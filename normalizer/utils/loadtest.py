@@ -0,0 +1,343 @@
+import csv
+import http.client
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+from .parser import STATEMENT_FORMATS
+from .warmup import WARMUP_SAMPLES
+
+# Link to the output on the result page of an upload
+DOWNLOAD_LINK_PATTERN = re.compile(rb'href="(/download/[0-9a-f]{32}/)"')
+
+READ_SIZE = 64 * 1024
+
+# First amount of a sample transaction line, varied in generated statements
+AMOUNT_PATTERN = re.compile(r'(?<=,)\d+(?= |,|$)')
+
+PERCENTILES = (50, 95, 99)
+
+
+def generate_statement(bank_format, rows, seed=0):
+    """
+    Returns a statement of about `rows` transactions in a bank's layout
+    The built-in warm-up sample of the bank is repeated after its header,
+    names and sections included, with the amounts varied.
+    """
+    is_header, parse_row = STATEMENT_FORMATS[bank_format]
+    lines = WARMUP_SAMPLES[bank_format].splitlines()
+    cells = list(csv.reader(lines))
+    header = next(i for i, line in enumerate(cells) if is_header(line))
+    body = list(zip(lines[header + 1:], cells[header + 1:]))
+    transactions = [line for line, row in body if parse_row(row, '', '')]
+
+    generator = random.Random(seed)
+    output = lines[:header + 1]
+    count = 0
+    while count < rows:
+        for line, row in body:
+            if line in transactions:
+                if count == rows:
+                    break
+                line = AMOUNT_PATTERN.sub(str(generator.randint(1, 99999)), line, count=1)
+                count += 1
+            output.append(line)
+    return '\n'.join(output) + '\n'
+
+
+def write_statements(directory, banks, sizes, seed=0):
+    """
+    Writes one generated statement per bank and size into a directory
+    Returns a list of (bank_format, rows, file_path); the bank name in the
+    filename is what picks the parser, as for real uploads
+    """
+    statements = []
+    for bank_format in banks:
+        for rows in sizes:
+            file_path = os.path.join(directory, f'{bank_format}-load-{rows}.csv')
+            with open(file_path, 'w', encoding='utf-8', newline='') as file:
+                file.write(generate_statement(bank_format, rows, seed))
+            statements.append((bank_format, rows, file_path))
+    return statements
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of numbers; None if it is empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+
+class LoadClient:
+    """
+    Uploads statements and downloads their outputs over plain HTTP
+
+    Every request goes over a new connection so sync and async worker
+    models are measured the same way. The CSRF cookie of the upload form is
+    fetched once and shared by all threads.
+    """
+
+    def __init__(self, base_url, host=None, timeout=300):
+        parts = urlsplit(base_url)
+        self.address = (parts.hostname, parts.port or 80)
+        self.host = host or parts.netloc
+        self.timeout = timeout
+        self.csrf_token = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Returns (status, headers, body) of a request"""
+        connection = http.client.HTTPConnection(*self.address, timeout=self.timeout)
+        try:
+            all_headers = {'Host': self.host, 'Connection': 'close'}
+            if self.csrf_token:
+                all_headers['Cookie'] = f'csrftoken={self.csrf_token}'
+                all_headers['X-CSRFToken'] = self.csrf_token
+            all_headers.update(headers or {})
+            connection.request(method, path, body=body, headers=all_headers)
+            response = connection.getresponse()
+            chunks = []
+            while True:
+                chunk = response.read(READ_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return response.status, response.headers, b''.join(chunks)
+        finally:
+            connection.close()
+
+    def fetch_csrf_token(self):
+        status, headers, body = self.request('GET', '/')
+        if status != 200:
+            raise ConnectionError(f'GET / returned {status}')
+        cookie = SimpleCookie()
+        for value in headers.get_all('Set-Cookie') or []:
+            cookie.load(value)
+        if 'csrftoken' not in cookie:
+            raise ConnectionError('No CSRF cookie on the upload form')
+        self.csrf_token = cookie['csrftoken'].value
+
+    def upload(self, file_path):
+        """Uploads a statement; returns (status, download path or None, body)"""
+        boundary = uuid.uuid4().hex
+        with open(file_path, 'rb') as file:
+            content = file.read()
+        body = b''.join([
+            f'--{boundary}\r\n'.encode('ascii'),
+            f'Content-Disposition: form-data; name="statement_file"; '
+            f'filename="{os.path.basename(file_path)}"\r\n'.encode('utf-8'),
+            b'Content-Type: text/csv\r\n\r\n',
+            content,
+            f'\r\n--{boundary}--\r\n'.encode('ascii'),
+        ])
+        status, headers, response = self.request('POST', '/upload/', body, {
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+        })
+        link = DOWNLOAD_LINK_PATTERN.search(response) if status == 200 else None
+        return status, link.group(1).decode('ascii') if link else None, response
+
+    def download(self, path):
+        """Downloads an output; returns (status, size in bytes)"""
+        status, headers, body = self.request('GET', path)
+        return status, len(body)
+
+
+def run_load(client, statements, total, concurrency, seed=0, on_result=None):
+    """
+    Uploads `total` statements picked at random from `statements` with
+    `concurrency` clients at a time, downloading each output after its
+    upload. Returns the list of results, one dict per request.
+    """
+    generator = random.Random(seed)
+    jobs = iter([generator.choice(statements) for _ in range(total)])
+    jobs_lock = threading.Lock()
+    results = []
+    started = time.perf_counter()
+
+    def record(endpoint, statement, request_started, ok, status, size=0, error=None):
+        result = {
+            'endpoint': endpoint,
+            'bank': statement[0],
+            'rows': statement[1],
+            'start': round(request_started - started, 4),
+            'latency': time.perf_counter() - request_started,
+            'ok': ok,
+            'status': status,
+            'bytes': size,
+            'error': error,
+        }
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    def work():
+        while True:
+            with jobs_lock:
+                statement = next(jobs, None)
+            if statement is None:
+                return
+            request_started = time.perf_counter()
+            try:
+                status, download_path, body = client.upload(statement[2])
+            except (OSError, http.client.HTTPException) as e:
+                record('upload', statement, request_started, False, None, error=str(e))
+                continue
+            ok = download_path is not None
+            record('upload', statement, request_started, ok, status, os.path.getsize(statement[2]),
+                   None if ok else f'HTTP {status} without a download link')
+            if not ok:
+                continue
+
+            request_started = time.perf_counter()
+            try:
+                status, size = client.download(download_path)
+            except (OSError, http.client.HTTPException) as e:
+                record('download', statement, request_started, False, None, error=str(e))
+                continue
+            record('download', statement, request_started, status == 200, status, size,
+                   None if status == 200 else f'HTTP {status}')
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(work) for _ in range(concurrency)]:
+            future.result()
+    return results
+
+
+def _read_memory(pid):
+    """Returns the RSS and PSS of a process in kB; PSS is None where it can't be read"""
+    memory = {'rss': None, 'pss': None}
+    with open(f'/proc/{pid}/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                memory['rss'] = int(line.split()[1])
+                break
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as file:
+            for line in file:
+                if line.startswith('Pss:'):
+                    memory['pss'] = int(line.split()[1])
+                    break
+    except OSError:
+        pass
+    return memory
+
+
+def _process_tree(root_pid):
+    """Returns {pid: depth} for a process and all of its descendants"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as file:
+                # The command name may contain spaces; the parent pid follows it
+                parent = int(file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    tree = {root_pid: 0}
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        for child in children.get(pid, ()):
+            tree[child] = tree[pid] + 1
+            pending.append(child)
+    return tree
+
+
+class MemorySampler:
+    """
+    Samples the memory of a server process and its descendants over time
+
+    Depth 0 is the server (the gunicorn master), depth 1 its workers and
+    depth 2 anything the workers start, such as the parse process pool.
+    Only works where /proc is available (Linux).
+    """
+
+    ROLES = ('master', 'worker', 'parse')
+
+    def __init__(self, root_pid, interval=1.0):
+        self.root_pid = root_pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+
+    @staticmethod
+    def available():
+        return os.path.exists('/proc/self/status')
+
+    def sample(self):
+        processes = {}
+        for pid, depth in _process_tree(self.root_pid).items():
+            try:
+                memory = _read_memory(pid)
+            except OSError:
+                continue  # Exited in the meantime
+            memory['role'] = self.ROLES[min(depth, len(self.ROLES) - 1)]
+            processes[str(pid)] = memory
+        self.samples.append({'time': round(time.perf_counter() - self._started, 2), 'processes': processes})
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name='memory-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        return False
+
+    def summary(self):
+        """Returns the first, peak and last RSS and PSS of every process seen, in kB"""
+        processes = {}
+        for sample in self.samples:
+            for pid, memory in sample['processes'].items():
+                summary = processes.setdefault(pid, {'role': memory['role'], 'first_rss': memory['rss'],
+                                                     'first_pss': memory['pss'], 'peak_rss': 0, 'peak_pss': 0})
+                summary['peak_rss'] = max(summary['peak_rss'], memory['rss'] or 0)
+                summary['peak_pss'] = max(summary['peak_pss'], memory['pss'] or 0)
+                summary['last_rss'] = memory['rss']
+                summary['last_pss'] = memory['pss']
+        return processes
+
+
+def summarize(results, elapsed):
+    """
+    Returns latency percentiles (ms), throughput and error rate per endpoint
+    """
+    summary = {}
+    for endpoint in ('upload', 'download'):
+        selected = [result for result in results if result['endpoint'] == endpoint]
+        latencies = [result['latency'] * 1000 for result in selected if result['ok']]
+        errors = [result for result in selected if not result['ok']]
+        summary[endpoint] = {
+            'requests': len(selected),
+            'errors': len(errors),
+            'error_rate': round(len(errors) / len(selected), 4) if selected else 0,
+            'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0,
+            'mean': round(sum(latencies) / len(latencies), 2) if latencies else None,
+            'max': round(max(latencies), 2) if latencies else None,
+            'bytes': sum(result['bytes'] for result in selected if result['ok']),
+        }
+        for percent in PERCENTILES:
+            value = percentile(latencies, percent)
+            summary[endpoint][f'p{percent}'] = round(value, 2) if value is not None else None
+        summary[endpoint]['error_messages'] = sorted({result['error'] for result in errors})[:5]
+    return summary
@@ -1,9 +1,73 @@
-import csv
+import hashlib
+import inspect
+import json
 import re
 import os
 from datetime import datetime
 from dateutil import parser as date_parser
 
+from .reader import StatementFile, read_sample
+from .rowindex import IndexedCsvWriter
+from .reftables import get_reference_tables
+from .provenance import ProvenanceWriter
+
+# Columns of the standardized output format
+OUTPUT_FIELDS = ['Date', 'Transaction Description', 'Debit', 'Credit', 'Currency', 'CardName', 'Transaction', 'Location']
+
+# Card holder names, section labels, cities and currency and international
+# keywords live in the shared reference tables (see reftables.py and
+# data/reference_tables.json); patterns are compiled once at import time so
+# that the first statement parsed by a fresh worker doesn't pay for them.
+# The rule helpers below take the `tables` to use, so a statement is parsed
+# (and fingerprinted) with one snapshot of them; without it they use the
+# current tables.
+
+CURRENCY_SYMBOLS_PATTERN = re.compile(r'[₹$€£,]')
+NON_NUMERIC_PATTERN = re.compile(r'[^\d.]')
+NON_ALPHANUMERIC_PATTERN = re.compile(r'[^a-zA-Z0-9]')
+DASHED_DATE_PATTERN = re.compile(r'\d{2}-\d{2}-\d{4}')
+
+def build_name_patterns(tables):
+    """Compiles a whole-word pattern for every card holder name"""
+    return tuple((name, re.compile(r'\b' + re.escape(name) + r'\b')) for name in tables.cardholder_names)
+
+def build_substring_lookup(keys):
+    """
+    Decodes the keys of a table once, for first_substring(): the keys in
+    table order, the first position of each key and the key lengths
+    """
+    keys = tuple(keys)
+    positions = {}
+    for position, key in enumerate(keys):
+        positions.setdefault(key, position)
+    return keys, positions, tuple(sorted({len(key) for key in keys}))
+
+def substring_lookup(tables, name, column=0):
+    """
+    Returns the substring lookup of a table (of one column of a pair
+    table), built once per snapshot of the reference tables
+    """
+    def build(tables):
+        table = getattr(tables, name)
+        return build_substring_lookup(table if table.columns == 1 else (row[column] for row in table))
+    return tables.derived(f'{name}_lookup_{column}', build)
+
+def first_substring(text, lookup):
+    """
+    Returns the position of the first key (in table order) found in `text`,
+    or -1. Short tables are scanned; for long ones every substring of `text`
+    with the length of a key is looked up instead.
+    """
+    keys, positions, lengths = lookup
+    if len(keys) <= len(text) * len(lengths):
+        for position, key in enumerate(keys):
+            if key in text:
+                return position
+        return -1
+    found = [positions[text[start:start + length]] for length in lengths
+             for start in range(len(text) - length + 1) if text[start:start + length] in positions]
+    return min(found, default=-1)
+
 def clean_amount(amount_str):
     """
     Cleans amount strings by removing currency symbols, commas, and handling credits
@@ -19,10 +83,10 @@ def clean_amount(amount_str):
         amount_str = amount_str.lower().replace('cr', '').strip()
     
     # Remove currency symbols and commas
-    amount_str = re.sub(r'[₹$€£,]', '', amount_str.strip())
+    amount_str = CURRENCY_SYMBOLS_PATTERN.sub('', amount_str.strip())
     
     # Handle any additional text that might appear
-    amount_str = re.sub(r'[^\d.]', '', amount_str.strip())
+    amount_str = NON_NUMERIC_PATTERN.sub('', amount_str.strip())
     
     try:
         amount = float(amount_str)
@@ -37,7 +101,7 @@ def parse_date(date_str):
     """
     try:
         # Handle the MM-DD-YYYY format specifically
-        if re.match(r'\d{2}-\d{2}-\d{4}', date_str):
+        if DASHED_DATE_PATTERN.match(date_str):
             parts = date_str.split('-')
             
             # Check if likely MM-DD-YYYY format (American style)
@@ -51,98 +115,85 @@ def parse_date(date_str):
         # Return empty string for invalid dates
         return ''
 
-def extract_location(description):
+def extract_location(description, tables=None):
     """
     Extracts location from transaction description
     """
-    # Common city names in India and internationally
-    common_cities = [
-        'delhi', 'mumbai', 'bangalore', 'chennai', 'kolkata', 'hyderabad', 
-        'pune', 'ahmedabad', 'jaipur', 'gurgaon', 'noida', 'gurugram', 
-        'newyork', 'california', 'berlin', 'katunayake', 'dusseldor'
-    ]
-    
     # Extract anything after the last space as potential location
     words = description.strip().split()
     if len(words) > 1:
+        cities = substring_lookup(tables or get_reference_tables(), 'common_cities')
+        
         # Check the last word first, if it's a common city
         last_word = words[-1].lower()
-        for city in common_cities:
-            if city in last_word:
-                return city
+        position = first_substring(last_word, cities)
+        if position != -1:
+            return cities[0][position]
         
         # If the last word is not a city, try the whole description
-        desc_lower = description.lower()
-        for city in common_cities:
-            if city in desc_lower:
-                return city
+        position = first_substring(description.lower(), cities)
+        if position != -1:
+            return cities[0][position]
                 
         # Default to the last word if no cities found
         location = last_word
         # Clean up location - remove any non-alphanumeric characters
-        location = re.sub(r'[^a-zA-Z0-9]', '', location)
+        location = NON_ALPHANUMERIC_PATTERN.sub('', location)
         return location
     return ""
 
-def detect_transaction_type(description, currency):
+def detect_transaction_type(description, currency, tables=None):
     """
     Determines if transaction is domestic or international based on description and currency
     """
     if currency not in ['INR', '']:
         return 'International'
     
-    international_keywords = ['international', 'foreign', 'overseas', 'euro', 'usd', 'eur', 'dollar', 'pound']
-    for keyword in international_keywords:
-        if keyword.lower() in description.lower():
-            return 'International'
+    keywords = substring_lookup(tables or get_reference_tables(), 'international_keywords')
+    if first_substring(description.lower(), keywords) != -1:
+        return 'International'
     
     return 'Domestic'
 
-def extract_currency_from_description(description, amount_str):
+def extract_currency_from_description(description, amount_str, tables=None):
     """
     Extract currency information from description and amount
     """
-    # Default currency
-    currency = 'INR'
+    tables = tables or get_reference_tables()
     
     # Check for currency in amount string
-    if 'EUR' in amount_str:
-        currency = 'EUR'
-    elif 'USD' in amount_str:
-        currency = 'USD'
-    elif 'POUND' in amount_str or '£' in amount_str:
-        currency = 'POUND'
+    position = first_substring(amount_str, substring_lookup(tables, 'amount_currency_markers'))
+    if position != -1:
+        return tables.amount_currency_markers[position][1]
     
     # Check in description if not found in amount
-    elif 'EUR' in description or 'EURO' in description:
-        currency = 'EUR'
-    elif 'USD' in description or 'DOLLAR' in description:
-        currency = 'USD'
-    elif 'POUND' in description or '£' in description:
-        currency = 'POUND'
+    position = first_substring(description, substring_lookup(tables, 'description_currency_markers'))
+    if position != -1:
+        return tables.description_currency_markers[position][1]
     
-    return currency
+    # Default currency
+    return 'INR'
 
-def is_name_row(line):
+def is_name_row(line, tables=None):
     """
     Checks if a CSV row contains just a name
     """
-    # Names we're looking for
-    names = ['Rahul', 'Ritu', 'Raj', 'Rajat']
-    
     # Check if the row has just one column with a name
     if line and len(line) >= 1:
+        tables = tables or get_reference_tables()
+        cardholder_names = tables.cardholder_names
+        
         # For single-cell name entries
-        if len(line) == 1 and line[0].strip() in names:
+        if len(line) == 1 and line[0].strip() in cardholder_names:
             return True, line[0].strip()
         
         # For names that might be in a specific cell pattern (like in IDFC format)
-        for i, cell in enumerate(line):
-            if cell.strip() in names and (i <= 2):  # Look in first 3 columns
+        for i, cell in enumerate(line[:3]):  # Look in first 3 columns
+            if cell.strip() in cardholder_names:
                 # Check if other cells in the row are mostly empty
                 other_cells_empty = True
                 for j, other_cell in enumerate(line):
-                    if j != i and other_cell.strip() and not other_cell.strip() in ['Domestic Transactions', 'International Transactions', 'Domestic Transaction', 'International Transaction']:
+                    if j != i and other_cell.strip() and not other_cell.strip() in tables.section_labels:
                         other_cells_empty = False
                         break
                 if other_cells_empty:
@@ -150,83 +201,69 @@ def is_name_row(line):
     
     return False, None
 
-def extract_name_from_file(file_path):
+class SectionTracker:
     """
-    Extracts all names from the file content for better name detection
+    Follows the card holder name and transaction type of the section a row
+    belongs to, one row at a time
     """
-    name_positions = {}
-    names = ['Rahul', 'Ritu', 'Raj', 'Rajat']
-    
-    with open(file_path, 'r', encoding='utf-8-sig') as file:
-        content = file.read()
-        
-        for name in names:
-            # Find all occurrences of this name using word boundaries
-            matches = list(re.finditer(r'\b' + name + r'\b', content))
-            for match in matches:
-                name_positions[match.start()] = name
-    
-    return name_positions
 
-def preprocess_file(file_path):
-    """
-    Pre-reads the file to identify sections and their names
-    Returns a mapping of line numbers to section names and types
-    """
-    section_map = {}
-    current_name = "Unknown"
-    current_type = "Domestic"
-    
-    # Pre-extract names from file content
-    name_positions = extract_name_from_file(file_path)
-    
-    with open(file_path, 'r', encoding='utf-8-sig') as file:
-        file_content = file.read()
-        lines = file_content.split('\n')
+    def __init__(self, delimiter=',', name="Unknown", type="Domestic", tables=None):
+        self.delimiter = delimiter
+        self.name = name
+        self.type = type
+        self.tables = tables or get_reference_tables()
+        self.name_patterns = self.tables.derived('name_patterns', build_name_patterns)
+
+    def update(self, line):
+        """
+        Updates the current section from a CSV row
+        Returns True if the row marks a section (name or type change)
+        """
+        # Check for name rows directly in CSV cells
+        name_result, name_value = is_name_row(line, self.tables)
+        if name_result:
+            self.name = name_value if name_value else line[0].strip()
+            return True
         
-        # Reset file pointer for CSV reader
-        file.seek(0)
-        reader = csv.reader(file)
+        marks_section = False
         
-        # Process each line
-        line_start_positions = [0]  # Start position of each line in the file
-        for i in range(len(lines) - 1):
-            line_start_positions.append(line_start_positions[-1] + len(lines[i]) + 1)
+        # Otherwise, check if any of our known names occur in this line
+        line_text = self.delimiter.join(line)
+        for name, pattern in self.name_patterns:
+            if pattern.search(line_text):
+                self.name = name
+                marks_section = True
+                break
         
-        for line_num, line in enumerate(reader):
-            # Find names that appear in this line
-            line_pos = line_start_positions[line_num]
-            
-            # Check for name rows directly in CSV cells
-            name_result, name_value = is_name_row(line)
-            if name_result:
-                current_name = name_value if name_value else line[0].strip()
-                section_map[line_num] = {"name": current_name, "type": current_type}
-                continue
-            
-            # Otherwise, check if any of our known names occur in this line range
-            for pos, name in name_positions.items():
-                if line_pos <= pos < (line_pos + len(lines[line_num])):
-                    current_name = name
-                    section_map[line_num] = {"name": current_name, "type": current_type}
-                    break
-            
-            # Check for transaction type headers
-            transaction_line = ''.join(line).lower()
-            if 'international' in transaction_line:
-                current_type = "International"
-                section_map[line_num] = {"name": current_name, "type": current_type}
-            elif 'domestic' in transaction_line:
-                current_type = "Domestic"
-                section_map[line_num] = {"name": current_name, "type": current_type}
-    
-    return section_map
+        # Check for transaction type headers
+        transaction_line = ''.join(line).lower()
+        if 'international' in transaction_line:
+            self.type = "International"
+            marks_section = True
+        elif 'domestic' in transaction_line:
+            self.type = "Domestic"
+            marks_section = True
+        
+        return marks_section
 
 def detect_bank_format(file_path):
     """
     Detects which bank format the CSV file follows based on its content
     Returns a string identifier: 'hdfc', 'icici', 'axis', or 'idfc'
     """
+    bank_format = detect_bank_format_from_name(file_path)
+    if bank_format != 'generic':
+        return bank_format
+    
+    # If filename doesn't give it away, check the content
+    content = read_sample(file_path, 1000)  # Read first 1000 chars for a sample
+    return detect_bank_format_from_sample(content)
+
+def detect_bank_format_from_name(file_path):
+    """
+    Detects the bank format from the filename alone
+    Returns 'generic' if the name doesn't mention a bank
+    """
     filename = os.path.basename(file_path).lower()
     
     if 'hdfc' in filename:
@@ -237,364 +274,423 @@ def detect_bank_format(file_path):
         return 'axis'
     elif 'idfc' in filename:
         return 'idfc'
-    
-    # If filename doesn't give it away, check the content
-    with open(file_path, 'r', encoding='utf-8-sig') as file:
-        content = file.read(1000)  # Read first 1000 chars for a sample
-        
-        if 'HDFC' in content:
-            return 'hdfc'
-        elif 'ICICI' in content:
-            return 'icici'
-        elif 'AXIS' in content:
-            return 'axis'
-        elif 'IDFC' in content:
-            return 'idfc'
+    return 'generic'
+
+def detect_bank_format_from_sample(content):
+    """
+    Detects the bank format from the first characters of a statement
+    """
+    if 'HDFC' in content:
+        return 'hdfc'
+    elif 'ICICI' in content:
+        return 'icici'
+    elif 'AXIS' in content:
+        return 'axis'
+    elif 'IDFC' in content:
+        return 'idfc'
     
     # Default to generic format if can't detect
     return 'generic'
 
-def find_current_section(line_number, section_map):
+def is_section_marker(line, tables=None):
+    """
+    Checks if a row is a card holder name or a section header rather than a transaction
+    """
+    name_result, name = is_name_row(line, tables)
+    return name_result or any('Transactions' in cell for cell in line)
+
+def apply_currency_rules(raw, tables=None):
     """
-    Finds the current section name and type based on line number
+    Works out the currency, debit and credit of a transaction from its raw fields
+    Statements with a single amount column mark credits with 'cr'
     """
-    current_name = "Unknown"
-    current_type = "Domestic"
+    description = raw['description']
+    if 'amount' not in raw:
+        debit_str, credit_str = raw['debit'], raw['credit']
+        debit = clean_amount(debit_str) if debit_str else 0
+        credit = clean_amount(credit_str) if credit_str else 0
+        
+        # Extract currency combining description
+        currency = extract_currency_from_description(description, debit_str + credit_str, tables)
+        return currency, debit, credit
+    
+    # Get the currency combining amount string and description
+    amount_str = raw['amount']
+    currency = extract_currency_from_description(description, amount_str, tables)
+    
+    # Clean the amount string by removing the currency
+    if currency != 'INR':
+        amount_str = amount_str.replace(currency, '').strip()
+    
+    # Determine if it's a credit or debit
+    is_credit = 'cr' in amount_str.lower()
+    amount = clean_amount(amount_str)
+    if is_credit:
+        return currency, 0, amount
+    return currency, amount, 0
+
+def standardize_fields(raw, current_name, current_type, tables=None):
+    """
+    Builds a standardized row from the raw fields of a transaction
+    Returns None if the row has no valid date
+    """
+    date = parse_date(raw['date'])
+    if not date:  # Only add rows with valid dates
+        return None
+    
+    currency, debit, credit = apply_currency_rules(raw, tables)
+    return {
+        'Date': date,
+        'Transaction Description': raw['description'],
+        'Debit': debit,
+        'Credit': credit,
+        'Currency': currency,
+        'CardName': current_name,
+        'Transaction': current_type,
+        'Location': extract_location(raw['description'], tables)
+    }
+
+def is_hdfc_header(line):
+    # Look for the header line that has "Date" in first column
+    return line and len(line) >= 3 and 'Date' in line[0]
+
+def parse_hdfc_row(line, current_name, current_type, tables=None):
+    """
+    Parses a transaction row of an HDFC statement
+    Returns a standardized row, or None if the row isn't a transaction
+    """
+    # Skip empty rows or header rows
+    if not line or len(line) < 3 or not line[0].strip() or 'Date' in line[0]:
+        return None
+    
+    # Check for name or section markers
+    if is_section_marker(line, tables):
+        return None
     
-    # Find the most recent section before this line
-    relevant_sections = {l: s for l, s in section_map.items() if l <= line_number}
-    if relevant_sections:
-        latest_section_line = max(relevant_sections.keys())
-        current_name = section_map[latest_section_line]["name"]
-        current_type = section_map[latest_section_line]["type"]
+    # Check if we have date, description, and amount
+    if not (len(line) >= 3 and line[0].strip() and line[1].strip()):
+        return None
     
-    return current_name, current_type
+    return standardize_fields(hdfc_raw_fields(line), current_name, current_type, tables)
+
+def hdfc_raw_fields(line):
+    """Date, description and amount (with any currency) as they appear in an HDFC row"""
+    return {
+        'date': line[0].strip(),
+        'description': line[1].strip(),
+        'amount': line[2].strip() if len(line) > 2 else '',
+    }
 
-def parse_hdfc_statement(file_path):
+def is_icici_header(line):
+    return line and len(line) >= 4 and 'Date' in line[0] and ('Transaction' in ''.join(line))
+
+def parse_icici_row(line, current_name, current_type, tables=None):
     """
-    Parse HDFC bank statement CSV format
+    Parses a transaction row of an ICICI statement
+    Returns a standardized row, or None if the row isn't a transaction
     """
-    rows = []
-    # Preprocess to get section mapping
-    section_map = preprocess_file(file_path)
+    # Skip empty rows or section headers
+    if not line or len(line) < 3 or not line[0].strip():
+        return None
     
-    with open(file_path, 'r', encoding='utf-8-sig') as file:
-        reader = csv.reader(file)
-        
-        # Skip initial non-transaction rows until we find the header
-        header_found = False
-        for header_line_num, line in enumerate(reader):
-            # Look for the header line that has "Date" in first column
-            if line and len(line) >= 3 and 'Date' in line[0]:
-                header_found = True
-                break
-        
-        # Process transactions
-        for line_num, line in enumerate(reader, start=header_line_num+1):
-            # Skip empty rows or header rows
-            if not line or len(line) < 3 or not line[0].strip() or 'Date' in line[0]:
-                continue
-            
-            # Check for name or section markers
-            name_result, name = is_name_row(line)
-            if name_result or any('Transactions' in cell for cell in line):
-                continue
-                
-            # Check if we have date, description, and amount
-            if len(line) >= 3 and line[0].strip() and line[1].strip():
-                # Get current section info
-                current_name, current_type = find_current_section(line_num, section_map)
-                
-                date = parse_date(line[0].strip())
-                description = line[1].strip()
-                
-                # Extract currency if included with amount
-                amount_str = line[2].strip() if len(line) > 2 else ""
-                
-                # Get the currency combining amount string and description
-                currency = extract_currency_from_description(description, amount_str)
-                
-                # Clean the amount string by removing the currency
-                if currency != 'INR':
-                    amount_str = amount_str.replace(currency, '').strip()
-                
-                # Determine if it's a credit or debit
-                is_credit = 'cr' in amount_str.lower()
-                amount = clean_amount(amount_str)
-                
-                debit = 0
-                credit = 0
-                
-                if is_credit:
-                    credit = amount
-                else:
-                    debit = amount
-                
-                # Extract location from description
-                location = extract_location(description)
-                
-                if date:  # Only add rows with valid dates
-                    rows.append({
-                        'Date': date,
-                        'Transaction Description': description,
-                        'Debit': debit,
-                        'Credit': credit,
-                        'Currency': currency,
-                        'CardName': current_name,
-                        'Transaction': current_type,
-                        'Location': location
-                    })
+    # Check for name or section markers
+    if is_section_marker(line, tables):
+        return None
     
-    return rows
+    return standardize_fields(icici_raw_fields(line), current_name, current_type, tables)
+
+def icici_raw_fields(line):
+    """Date, description, debit and credit as they appear in an ICICI row"""
+    return {
+        'date': line[0].strip(),
+        'description': line[1].strip() if len(line) > 1 and line[1].strip() else "Unknown Transaction",
+        # ICICI has separate debit and credit columns
+        'debit': line[2].strip() if len(line) > 2 else '',
+        'credit': line[3].strip() if len(line) > 3 else '',
+    }
+
+def is_axis_header(line):
+    return line and len(line) >= 4 and 'Date' in line[0] and 'Debit' in line[1] and 'Credit' in line[2]
 
-def parse_icici_statement(file_path):
+def parse_axis_row(line, current_name, current_type, tables=None):
     """
-    Parse ICICI bank statement CSV format
+    Parses a transaction row of an Axis statement
+    Returns a standardized row, or None if the row isn't a transaction
     """
-    rows = []
-    # Preprocess to get section mapping
-    section_map = preprocess_file(file_path)
+    # Skip empty rows or section headers
+    if not line or len(line) < 4 or not line[0].strip():
+        return None
     
-    with open(file_path, 'r', encoding='utf-8-sig') as file:
-        reader = csv.reader(file)
-        
-        # Skip initial non-transaction rows
-        header_found = False
-        for header_line_num, line in enumerate(reader):
-            if line and len(line) >= 4 and 'Date' in line[0] and ('Transaction' in ''.join(line)):
-                header_found = True
-                break
-        
-        # Start processing transactions
-        for line_num, line in enumerate(reader, start=header_line_num+1):
-            # Skip empty rows or section headers
-            if not line or len(line) < 3 or not line[0].strip():
-                continue
-            
-            # Check for name or section markers
-            name_result, name = is_name_row(line)
-            if name_result or any('Transactions' in cell for cell in line):
-                continue
-                
-            # Check if we have date and description
-            if len(line) >= 3 and line[0].strip():
-                # Get current section info
-                current_name, current_type = find_current_section(line_num, section_map)
-                
-                date = parse_date(line[0].strip())
-                description = line[1].strip() if len(line) > 1 and line[1].strip() else "Unknown Transaction"
-                
-                # ICICI has separate debit and credit columns
-                debit_str = line[2].strip() if len(line) > 2 else ''
-                credit_str = line[3].strip() if len(line) > 3 else ''
-                
-                # Parse amounts
-                debit = clean_amount(debit_str) if debit_str else 0
-                credit = clean_amount(credit_str) if credit_str else 0
-                
-                # Extract currency combining description 
-                currency = extract_currency_from_description(description, debit_str + credit_str)
-                
-                # Extract location from description
-                location = extract_location(description)
-                
-                if date:  # Only add rows with valid dates
-                    rows.append({
-                        'Date': date,
-                        'Transaction Description': description,
-                        'Debit': debit,
-                        'Credit': credit,
-                        'Currency': currency,
-                        'CardName': current_name,
-                        'Transaction': current_type,
-                        'Location': location
-                    })
+    # Check for name or section markers
+    if is_section_marker(line, tables):
+        return None
     
-    return rows
+    # Check if we have date and transaction details
+    if not line[3].strip():
+        return None
+    
+    return standardize_fields(axis_raw_fields(line), current_name, current_type, tables)
+
+def axis_raw_fields(line):
+    """Date, description, debit and credit as they appear in an Axis row"""
+    return {
+        'date': line[0].strip(),
+        'description': line[3].strip(),
+        # Axis has separate debit and credit columns
+        'debit': line[1].strip() if len(line) > 1 else '',
+        'credit': line[2].strip() if len(line) > 2 else '',
+    }
+
+def is_idfc_header(line):
+    return line and len(line) >= 3 and 'Transaction Details' in line[0] and 'Date' in line[1] and 'Amount' in line[2]
 
-def parse_axis_statement(file_path):
+def parse_idfc_row(line, current_name, current_type, tables=None):
     """
-    Parse Axis bank statement CSV format
+    Parses a transaction row of an IDFC statement
+    Returns a standardized row, or None if the row isn't a transaction
     """
-    rows = []
-    # Preprocess to get section mapping
-    section_map = preprocess_file(file_path)
+    # Skip empty rows or section headers
+    if not line or len(line) < 3 or not line[0].strip():
+        return None
     
-    with open(file_path, 'r', encoding='utf-8-sig') as file:
-        reader = csv.reader(file)
-        
-        # Skip initial non-transaction rows
-        header_found = False
-        for header_line_num, line in enumerate(reader):
-            if line and len(line) >= 4 and 'Date' in line[0] and 'Debit' in line[1] and 'Credit' in line[2]:
-                header_found = True
-                break
-        
-        if not header_found:
-            return rows  # Return empty if format doesn't match
-        
-        # Start processing transactions
-        for line_num, line in enumerate(reader, start=header_line_num+1):
-            # Skip empty rows or section headers
-            if not line or len(line) < 4 or not line[0].strip():
-                continue
-            
-            # Check for name or section markers
-            name_result, name = is_name_row(line)
-            if name_result or any('Transactions' in cell for cell in line):
-                continue
-                
-            # Check if we have date and transaction details
-            if len(line) >= 4 and line[0].strip() and line[3].strip():
-                # Get current section info
-                current_name, current_type = find_current_section(line_num, section_map)
-                
-                date = parse_date(line[0].strip())
-                description = line[3].strip()
-                
-                # Axis has separate debit and credit columns
-                debit_str = line[1].strip() if len(line) > 1 else ''
-                credit_str = line[2].strip() if len(line) > 2 else ''
-                
-                # Parse amounts
-                debit = clean_amount(debit_str) if debit_str else 0
-                credit = clean_amount(credit_str) if credit_str else 0
-                
-                # Extract currency combining description
-                currency = extract_currency_from_description(description, debit_str + credit_str)
-                
-                # Extract location from description
-                location = extract_location(description)
-                
-                if date:  # Only add rows with valid dates
-                    rows.append({
-                        'Date': date,
-                        'Transaction Description': description,
-                        'Debit': debit,
-                        'Credit': credit,
-                        'Currency': currency,
-                        'CardName': current_name,
-                        'Transaction': current_type,
-                        'Location': location
-                    })
+    # Check for name or section markers
+    if is_section_marker(line, tables):
+        return None
+    
+    # Check if we have transaction details and date
+    if not line[1].strip():
+        return None
     
-    return rows
+    return standardize_fields(idfc_raw_fields(line), current_name, current_type, tables)
+
+def idfc_raw_fields(line):
+    """Date, description and amount (with any currency) as they appear in an IDFC row"""
+    return {
+        'date': line[1].strip(),
+        'description': line[0].strip(),
+        'amount': line[2].strip() if len(line) > 2 else '',
+    }
+
+# Header detection and row parsing for each bank format
+STATEMENT_FORMATS = {
+    'hdfc': (is_hdfc_header, parse_hdfc_row),
+    'icici': (is_icici_header, parse_icici_row),
+    'axis': (is_axis_header, parse_axis_row),
+    'idfc': (is_idfc_header, parse_idfc_row),
+}
 
-def parse_idfc_statement(file_path):
+# Raw field extraction of each bank format, used to re-apply changed rules
+RAW_FIELDS = {
+    'hdfc': hdfc_raw_fields,
+    'icici': icici_raw_fields,
+    'axis': axis_raw_fields,
+    'idfc': idfc_raw_fields,
+}
+
+# Rule families behind the derived columns of the output: the columns each
+# family produces, the functions that implement it and the reference tables
+# it reads. Bump a version to force a re-run when a rule changes in a way
+# the fingerprint can't see, such as a helper or pattern used by the functions.
+RULE_FAMILIES = {
+    'location': {
+        'version': 1,
+        'columns': ('Location',),
+        'functions': (extract_location,),
+        'tables': ('common_cities',),
+    },
+    'currency': {
+        'version': 1,
+        'columns': ('Currency', 'Debit', 'Credit'),
+        'functions': (apply_currency_rules, extract_currency_from_description, clean_amount),
+        'tables': ('amount_currency_markers', 'description_currency_markers'),
+    },
+    'name': {
+        'version': 1,
+        'columns': ('CardName',),
+        'functions': (SectionTracker.update, is_name_row, build_name_patterns),
+        'tables': ('cardholder_names', 'section_labels'),
+    },
+    'section': {
+        'version': 1,
+        'columns': ('Transaction',),
+        'functions': (SectionTracker.update, is_name_row),
+        'tables': ('cardholder_names', 'section_labels'),
+    },
+}
+
+def build_rule_fingerprints(tables):
     """
-    Parse IDFC bank statement CSV format
+    Hashes the version, source code and reference data of every rule family
+    """
+    fingerprints = {}
+    for family, rules in RULE_FAMILIES.items():
+        digest = hashlib.sha256(str(rules['version']).encode('utf-8'))
+        for function in rules['functions']:
+            try:
+                digest.update(inspect.getsource(function).encode('utf-8'))
+            except (OSError, TypeError):
+                # No source shipped; the bytecode changes with the code too
+                digest.update(function.__code__.co_code)
+        for table_name in rules['tables']:
+            digest.update(json.dumps(list(getattr(tables, table_name))).encode('utf-8'))
+        fingerprints[family] = digest.hexdigest()[:12]
+    return fingerprints
+
+def rule_fingerprints(tables=None):
+    """
+    Returns the fingerprint of each rule family with the given (by default
+    the current) reference tables; a family's fingerprint changes whenever
+    its code or reference data does
+    """
+    return (tables or get_reference_tables()).derived('rule_fingerprints', build_rule_fingerprints)
+
+class StatementRowParser:
+    """
+    Parses a statement one CSV row at a time
+
+    Rows before the bank's header row are skipped; every row, header or
+    not, updates the current card holder and section. The parser's state
+    can be saved with get_state() and restored with from_state(), so a
+    statement can be parsed in several sittings as it arrives. Every row
+    is parsed with the same reference tables, `tables` (by default the
+    current ones when the parser is created); the state records their
+    version, and a parser is only restored with tables of that version.
+    """
+
+    def __init__(self, bank_format, delimiter=',', tables=None):
+        self.bank_format = bank_format
+        self.is_header, self.parse_row = STATEMENT_FORMATS[bank_format]
+        self.tables = tables or get_reference_tables()
+        self.sections = SectionTracker(delimiter, tables=self.tables)
+        self.header_found = False
+
+    def feed(self, line):
+        """
+        Feeds the next CSV row; returns a standardized row or None
+        """
+        self.sections.update(line)
+        if not self.header_found:
+            self.header_found = bool(self.is_header(line))
+            return None
+        return self.parse_row(line, self.sections.name, self.sections.type, self.tables)
+
+    def get_state(self):
+        return {
+            'bank_format': self.bank_format,
+            'delimiter': self.sections.delimiter,
+            'header_found': self.header_found,
+            'name': self.sections.name,
+            'type': self.sections.type,
+            'tables_version': self.tables.version,
+        }
+
+    @classmethod
+    def from_state(cls, state, tables=None):
+        tables = tables or get_reference_tables()
+        if tables.version != state['tables_version']:
+            raise ValueError(f"Parser state is for reference tables {state['tables_version']}, not {tables.version}")
+        parser = cls(state['bank_format'], state['delimiter'], tables)
+        parser.header_found = state['header_found']
+        parser.sections.name = state['name']
+        parser.sections.type = state['type']
+        return parser
+
+def parse_statement_file(file_path, bank_format, recorder=None, writer=None):
+    """
+    Parses a statement file with the given bank format in a single pass
+    With `writer` (an IndexedCsvWriter) each row is written as soon as it is
+    parsed and the number of rows is returned; otherwise the rows are.
+    Every line is also passed to `recorder` (a ProvenanceWriter) if given
     """
     rows = []
-    # Preprocess to get section mapping
-    section_map = preprocess_file(file_path)
-    
-    with open(file_path, 'r', encoding='utf-8-sig') as file:
-        reader = csv.reader(file)
-        
-        # Skip initial non-transaction rows
-        header_found = False
-        for header_line_num, line in enumerate(reader):
-            if line and len(line) >= 3 and 'Transaction Details' in line[0] and 'Date' in line[1] and 'Amount' in line[2]:
-                header_found = True
-                break
-        
-        # Start processing transactions
-        for line_num, line in enumerate(reader, start=header_line_num+1):
-            # Skip empty rows or section headers
-            if not line or len(line) < 3 or not line[0].strip():
-                continue
-            
-            # Check for name or section markers
-            name_result, name = is_name_row(line)
-            if name_result or any('Transactions' in cell for cell in line):
-                continue
-                
-            # Check if we have transaction details and date
-            if len(line) >= 3 and line[0].strip() and line[1].strip():
-                # Get current section info
-                current_name, current_type = find_current_section(line_num, section_map)
-                
-                date = parse_date(line[1].strip())
-                description = line[0].strip()
-                
-                # Extract currency
-                amount_str = line[2].strip() if len(line) > 2 else ''
-                currency = extract_currency_from_description(description, amount_str)
-                
-                # Clean amount string by removing currency if needed
-                if currency != 'INR':
-                    amount_str = amount_str.replace(currency, '').strip()
-                
-                is_credit = 'cr' in amount_str.lower()
-                amount = clean_amount(amount_str)
-                
-                debit = 0
-                credit = 0
-                
-                if is_credit:
-                    credit = amount
+    count = 0
+    if writer is not None:
+        writer.restart()
+    
+    with StatementFile(file_path) as statement:
+        parser = StatementRowParser(bank_format, statement.dialect.delimiter)
+        if recorder is not None:
+            recorder.start(bank_format, statement.dialect.delimiter)
+            recorder.set_rules(rule_fingerprints(parser.tables))
+        for line in statement.rows():
+            row = parser.feed(line)
+            if row:
+                if writer is None:
+                    rows.append(row)
                 else:
-                    debit = amount
-                
-                # Extract location from description
-                location = extract_location(description)
-                
-                if date:  # Only add rows with valid dates
-                    rows.append({
-                        'Date': date,
-                        'Transaction Description': description,
-                        'Debit': debit,
-                        'Credit': credit,
-                        'Currency': currency,
-                        'CardName': current_name,
-                        'Transaction': current_type,
-                        'Location': location
-                    })
+                    writer.writerow(row)
+                    count += 1
+            if recorder is not None:
+                recorder.record(line, row)
     
-    return rows
+    return rows if writer is None else count
+
+def parse_hdfc_statement(file_path, recorder=None, writer=None):
+    """
+    Parse HDFC bank statement CSV format
+    """
+    return parse_statement_file(file_path, 'hdfc', recorder, writer)
+
+def parse_icici_statement(file_path, recorder=None, writer=None):
+    """
+    Parse ICICI bank statement CSV format
+    """
+    return parse_statement_file(file_path, 'icici', recorder, writer)
+
+def parse_axis_statement(file_path, recorder=None, writer=None):
+    """
+    Parse Axis bank statement CSV format
+    """
+    return parse_statement_file(file_path, 'axis', recorder, writer)
+
+def parse_idfc_statement(file_path, recorder=None, writer=None):
+    """
+    Parse IDFC bank statement CSV format
+    """
+    return parse_statement_file(file_path, 'idfc', recorder, writer)
 
-def parse_csv_statement(file_path):
+def parse_csv_statement(file_path, recorder=None, writer=None):
     """
     Main function to parse bank statements
     Detects format and dispatches to appropriate parser
+    See parse_statement_file for `recorder` and `writer`
     """
     bank_format = detect_bank_format(file_path)
     
     if bank_format == 'hdfc':
-        return parse_hdfc_statement(file_path)
+        return parse_hdfc_statement(file_path, recorder, writer)
     elif bank_format == 'icici':
-        return parse_icici_statement(file_path)
+        return parse_icici_statement(file_path, recorder, writer)
     elif bank_format == 'axis':
-        return parse_axis_statement(file_path)
+        return parse_axis_statement(file_path, recorder, writer)
     elif bank_format == 'idfc':
-        return parse_idfc_statement(file_path)
+        return parse_idfc_statement(file_path, recorder, writer)
     else:
         # Generic fallback
         try:
-            return parse_hdfc_statement(file_path)
+            return parse_hdfc_statement(file_path, recorder, writer)
         except:
             try:
-                return parse_icici_statement(file_path)
+                return parse_icici_statement(file_path, recorder, writer)
             except:
                 try:
-                    return parse_axis_statement(file_path)
+                    return parse_axis_statement(file_path, recorder, writer)
                 except:
                     try:
-                        return parse_idfc_statement(file_path)
+                        return parse_idfc_statement(file_path, recorder, writer)
                     except:
-                        return []  # Return empty if all fail
+                        return [] if writer is None else 0  # Return empty if all fail
 
-def standardize_statement(input_file, output_file):
+def standardize_statement(input_file, output_file, compression=None):
     """
     Reads a raw bank statement CSV file, normalizes it to a standard format,
     and writes the result to a new CSV file.
-    """
-    rows = parse_csv_statement(input_file)
-    
-    # Write standardized output to CSV file
-    with open(output_file, 'w', newline='', encoding='utf-8') as file:
-        writer = csv.DictWriter(file, fieldnames=['Date', 'Transaction Description', 'Debit', 'Credit', 'Currency', 'CardName', 'Transaction', 'Location'])
-        writer.writeheader()
-        writer.writerows(rows)
-    
-    return len(rows)  # Return number of rows processed 
\ No newline at end of file
+    A row index for previews and the provenance needed to re-apply changed
+    rules are written next to it (see rowindex.py and provenance.py).
+    With compression='gzip' the output is written gzip compressed.
+    """
+    # Rows go straight to the output as they are parsed, so memory use
+    # doesn't grow with the size of the statement
+    with IndexedCsvWriter(output_file, OUTPUT_FIELDS, compression=compression) as writer:
+        with ProvenanceWriter(output_file) as recorder:
+            return parse_csv_statement(input_file, recorder, writer)  # Number of rows processed
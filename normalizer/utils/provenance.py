@@ -0,0 +1,176 @@
+import csv
+import gzip
+import io
+import json
+import os
+
+from .compression import SeekableGzipWriter
+
+# Sidecar written next to every standardized output of a known bank format
+PROVENANCE_SUFFIX = '.provenance.gz'
+
+# Small summary of the rule fingerprints in a provenance file, so outputs that
+# are up to date can be skipped without reading the whole file
+RULES_SUFFIX = '.rules.json'
+
+# Kinds of line in a provenance file; the first column holds the kind, or
+# the output row number for a line that became a row, or '' for other lines
+STATEMENT_LINE = '#statement'
+RULES_LINE = '#rules'
+
+# Lines are collected and compressed in batches of about this many characters
+WRITE_BATCH_SIZE = 64 * 1024
+
+
+class ProvenanceWriter:
+    """
+    Records every line a statement parser is fed, gzip compressed
+
+    The provenance of an output keeps the raw CSV cells of the statement,
+    which output row each line became, and the rule fingerprints each row
+    was produced with (see parser.rule_fingerprints), so rows can later be
+    brought up to date with changed rules without the original upload.
+
+    It is written to `<output path>.provenance.gz`. Like ResumableCsvWriter
+    it can be written over several sessions: pass the previous get_state(),
+    and final=True on the last one.
+    """
+
+    def __init__(self, output_path, state=None, final=True):
+        self.output_path = output_path
+        self.file_path = output_path + PROVENANCE_SUFFIX
+        self.final = final
+        self.rows = 0
+        self.rules = None
+        self.rule_sets = []
+        self._sink_state = None
+        self._written_rules = None
+        if state is not None:
+            self.rows = state['rows']
+            self.rule_sets = state['rule_sets']
+            self._written_rules = state['rules']
+            self._sink_state = state['sink']
+        self._file = None
+        self._sink = None
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+
+    def __enter__(self):
+        if self._sink_state is None:
+            self._file = open(self.file_path, 'wb')
+        else:
+            # Drop anything a failed session wrote after its last saved state
+            self._file = open(self.file_path, 'r+b')
+            self._file.truncate(self._sink_state['compressed'])
+            self._file.seek(self._sink_state['compressed'])
+        self._sink = SeekableGzipWriter(self._file, self._sink_state)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._flush()
+            if self.final:
+                self._sink.finish()
+            else:
+                self._sink_state = self._sink.get_state()
+        self._file.close()
+        if exc_type is None and self.final:
+            write_rules_summary(self.output_path, self.rule_sets)
+        return False
+
+    def _write_line(self, values):
+        self._writer.writerow(values)
+        if self._buffer.tell() >= WRITE_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        self._sink.write(self._buffer.getvalue().encode('utf-8'))
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    def start(self, bank_format, delimiter):
+        """
+        Starts the record of a statement; anything recorded before is
+        discarded (a parse that is retried with another bank format)
+        """
+        if self.rows or self._sink.size or self._buffer.tell():
+            self._buffer.seek(0)
+            self._buffer.truncate()
+            self._file.seek(0)
+            self._file.truncate()
+            self._sink = SeekableGzipWriter(self._file)
+            self.rows = 0
+            self.rule_sets = []
+            self._written_rules = None
+        self._write_line([STATEMENT_LINE, bank_format, delimiter])
+
+    def set_rules(self, fingerprints):
+        """Sets the rule fingerprints of the rows recorded from now on"""
+        self.rules = fingerprints
+
+    def record(self, line, row=None):
+        """Records a statement line and whether it became an output row"""
+        if row is None:
+            self._write_line([''] + list(line))
+            return
+        if self.rules != self._written_rules:
+            self._write_line([RULES_LINE, json.dumps(self.rules, sort_keys=True)])
+            self._written_rules = self.rules
+            if self.rules not in self.rule_sets:
+                self.rule_sets.append(self.rules)
+        self._write_line([str(self.rows)] + list(line))
+        self.rows += 1
+
+    def get_state(self):
+        return {
+            'rows': self.rows,
+            'rules': self._written_rules,
+            'rule_sets': self.rule_sets,
+            'sink': self._sink_state,
+        }
+
+
+def write_rules_summary(output_path, rule_sets):
+    """Writes the distinct rule fingerprints the rows of an output were produced with"""
+    temp_path = output_path + RULES_SUFFIX + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump({'rule_sets': rule_sets}, file)
+    os.replace(temp_path, output_path + RULES_SUFFIX)
+
+
+def read_rules_summary(output_path):
+    """Returns the rule fingerprint sets of an output, or None without provenance"""
+    try:
+        with open(output_path + RULES_SUFFIX, encoding='utf-8') as file:
+            return json.load(file)['rule_sets']
+    except FileNotFoundError:
+        return None
+
+
+def read_provenance(output_path):
+    """
+    Reads the provenance of an output
+    Returns (bank_format, delimiter, lines) where lines yields
+    (row_number or None, rule fingerprints or None, cells) for each line
+    """
+    file_path = output_path + PROVENANCE_SUFFIX
+    file = gzip.open(file_path, 'rt', newline='', encoding='utf-8')
+    reader = csv.reader(file)
+    first = next(reader, None)
+    if not first or first[0] != STATEMENT_LINE:
+        file.close()
+        raise ValueError(f'{file_path} is not a provenance file')
+
+    def lines():
+        with file:
+            rules = None
+            for line in reader:
+                kind = line[0]
+                if kind == RULES_LINE:
+                    rules = json.loads(line[1])
+                elif kind:
+                    yield int(kind), rules, line[1:]
+                else:
+                    yield None, None, line[1:]
+
+    return first[1], first[2], lines()
@@ -0,0 +1,200 @@
+import codecs
+import csv
+import io
+
+from .compression import ZSTD_MAGIC, detect_compression, open_decompressed
+
+# How much of the file is looked at to guess the encoding and the delimiter
+SNIFF_SAMPLE_SIZE = 64 * 1024
+
+# Delimiters we are willing to accept from the sniffer
+CANDIDATE_DELIMITERS = ',;\t|'
+
+# Encodings whose line breaks, quotes and delimiters are single ASCII bytes,
+# so that rows can be split on the raw bytes without decoding them first
+ASCII_COMPATIBLE_ENCODINGS = ('utf-8', 'utf-8-sig', 'cp1252')
+
+# How much of a buffer is decoded and split into rows at a time
+BUFFER_BLOCK_SIZE = 1024 * 1024
+
+
+def sniff_encoding(sample):
+    """
+    Guesses the encoding of a statement from the first bytes of the file
+    Returns a tuple of (encoding, bom_length)
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig', len(codecs.BOM_UTF8)
+    if sample.startswith(codecs.BOM_UTF16_LE) or sample.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16', 0
+
+    # UTF-16 without a BOM shows up as a NUL byte next to every ASCII character
+    head = sample[:200]
+    if head and head.count(b'\x00') > len(head) // 4:
+        return ('utf-16-le' if head[1::2].count(b'\x00') > head[0::2].count(b'\x00') else 'utf-16-be'), 0
+
+    try:
+        sample.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off by the end of the sample is still UTF-8
+        if e.reason != 'unexpected end of data':
+            return 'cp1252', 0
+    return 'utf-8', 0
+
+
+def sniff_dialect(sample_text):
+    """
+    Guesses the CSV dialect from a decoded sample of the statement
+    Falls back to the standard comma separated dialect
+    """
+    # Only look at complete lines so a cut-off row doesn't confuse the sniffer
+    if '\n' in sample_text:
+        sample_text = sample_text[:sample_text.rindex('\n')]
+    try:
+        dialect = csv.Sniffer().sniff(sample_text, delimiters=CANDIDATE_DELIMITERS)
+    except csv.Error:
+        return csv.excel
+    return make_dialect(dialect.delimiter)
+
+
+def make_dialect(delimiter):
+    """
+    Returns the standard CSV dialect with a different delimiter
+    """
+    if delimiter == csv.excel.delimiter:
+        return csv.excel
+
+    class SniffedDialect(csv.excel):
+        pass
+    SniffedDialect.delimiter = delimiter
+    return SniffedDialect
+
+
+class StatementFile:
+    """
+    Read-only view of a statement file on disk
+
+    Encoding and delimiter are sniffed from the start of the file, and rows
+    are read with csv.reader through a decoder that reads a buffer at a time,
+    so memory stays bounded however large the file is. gzip and zstd
+    compressed files are decompressed as they are read.
+    Use as a context manager: rows can only be read while the file is open.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.encoding = 'utf-8'
+        self.dialect = csv.excel
+        self.compression = None
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.file_path, 'rb')
+        self.compression = detect_compression(self._file.read(len(ZSTD_MAGIC)))
+        self._file.seek(0)
+
+        stream = self._open_stream()
+        try:
+            sample = stream.read(SNIFF_SAMPLE_SIZE)
+        finally:
+            if stream is not self._file:
+                stream.close()
+        self.encoding, _ = sniff_encoding(sample)
+        self.dialect = sniff_dialect(sample.decode(self.encoding, errors='ignore'))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        self._file = None
+        return False
+
+    def _open_stream(self):
+        """Returns a binary stream of the (decompressed) content from the start"""
+        if self.compression is None:
+            self._file.seek(0)
+            return self._file
+        return io.BufferedReader(open_decompressed(self.file_path, self.compression))
+
+    def read_text(self, size):
+        """
+        Returns up to `size` decoded characters from the start of the file
+        """
+        stream = self._open_stream()
+        text = io.TextIOWrapper(stream, encoding=self.encoding, errors='replace', newline='')
+        try:
+            return text.read(size)
+        finally:
+            text.detach()
+            if stream is not self._file:
+                stream.close()
+
+    def rows(self):
+        """
+        Yields every CSV record of the file, as lists of strings
+        """
+        stream = self._open_stream()
+        text = io.TextIOWrapper(stream, encoding=self.encoding, errors='replace', newline='')
+        try:
+            yield from csv.reader(text, self.dialect)
+        finally:
+            text.detach()
+            if stream is not self._file:
+                stream.close()
+
+
+def is_byte_splittable(encoding, dialect):
+    """Whether rows in this encoding and dialect can be split on raw bytes"""
+    return (encoding in ASCII_COMPATIBLE_ENCODINGS
+            and len(dialect.delimiter.encode(_field_encoding(encoding))) == 1
+            and len(dialect.quotechar.encode(_field_encoding(encoding))) == 1)
+
+
+def _field_encoding(encoding):
+    # The BOM is skipped once at the start of the file, never inside a field
+    return 'utf-8' if encoding == 'utf-8-sig' else encoding
+
+
+def iter_buffer_blocks(data, start, end, encoding, dialect, final=True, block_size=BUFFER_BLOCK_SIZE):
+    """
+    Yields (rows, next_position) for blocks of CSV records in data[start:end]
+
+    Works on any buffer (bytes or mmap) in an ASCII compatible encoding. Each
+    block ends at a line break outside quotes and is decoded and split by
+    csv.reader in one go. With final=False a trailing record that may still
+    be incomplete (no line break yet, or an open quote) is left for the next
+    call, which should start at the last next_position yielded.
+    """
+    encoding = _field_encoding(encoding)
+    quote = dialect.quotechar.encode(encoding)
+    pos = start
+
+    while pos < end:
+        block_end = min(pos + block_size, end)
+        block = data[pos:block_end]
+        if block_end == end and final:
+            cut = len(block)
+        else:
+            # Cut after the last line break with an even number of quotes
+            # before it; quoted fields may contain line breaks
+            cut = block.rfind(b'\n')
+            while cut != -1 and block.count(quote, 0, cut) % 2:
+                cut = block.rfind(b'\n', 0, cut)
+            if cut == -1:
+                if block_end == end:
+                    return
+                # A record longer than the block, so read a larger one
+                block_size *= 2
+                continue
+            cut += 1
+
+        text = block[:cut].decode(encoding, errors='replace')
+        yield list(csv.reader(io.StringIO(text, newline=''), dialect)), pos + cut
+        pos += cut
+
+
+def read_sample(file_path, size=1000):
+    """
+    Returns up to `size` decoded characters from the start of a statement file
+    """
+    with StatementFile(file_path) as statement:
+        return statement.read_text(size)
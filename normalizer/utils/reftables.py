@@ -0,0 +1,385 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Source of the lookup data the parser needs, compiled into REFERENCE_TABLES_PATH
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'reference_tables.json')
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'media', 'reference',
+                            'tables.bin')
+
+# Layout: magic, length of the JSON directory, the directory, then for every
+# table the start of each string (uint32, rows * columns + 1), a hash index
+# of the first column (uint32 slots holding row + 1, 0 when empty) and the
+# UTF-8 text of its strings, each followed by a NUL byte. The directory
+# gives the position of each part after the directory.
+TABLES_MAGIC = b'NRTAB1\x00\x00'
+TABLES_HEADER = struct.Struct('<8sI')
+UINT32 = struct.Struct('<I')
+UINT32_PAIR = struct.Struct('<II')
+SEPARATOR = '\x00'
+
+# Seconds between checks for a recompiled or edited table file
+DEFAULT_CHECK_INTERVAL = 5
+
+# Tables with up to this much text are decoded once per process, since the
+# parser scans them on every row; larger ones (gazetteers, merchant lists)
+# are only ever read from the shared mapping
+SMALL_TABLE_BYTES = 16 * 1024
+
+# Attributes of ReferenceTables that a table can't be named after
+RESERVED_TABLE_NAMES = frozenset(['path', 'stat', 'directory', 'version', 'tables', 'derived'])
+
+
+def _hash_slots(rows):
+    """Slots of a hash index: a power of two, at most a quarter full so misses stop early"""
+    slots = 1
+    while slots < rows * 4:
+        slots *= 2
+    return slots
+
+
+class MappedTable:
+    """
+    One read-only table of a compiled reference file
+
+    Rows are single strings, or (key, value) pairs for two column tables,
+    and keep the order of the source. `in` and get() go through the hash
+    index and only read the candidate rows; iterating decodes the table's
+    text in one go. Small tables are decoded up front instead (see
+    SMALL_TABLE_BYTES) so the per-row lookups cost the same as on a tuple.
+    """
+
+    def __init__(self, data, base, info):
+        self._data = data
+        self.rows = info['rows']
+        self.columns = info['columns']
+        self._slots = info['slots']
+        self._key_lengths = info['key_lengths']
+        self._offsets = base + info['offsets']
+        self._index = base + info['index']
+        self._text = base + info['text']
+        self._text_end = self._text + info['text_length']
+        self._values = None
+        self._rows_by_key = None
+        if info['text_length'] <= SMALL_TABLE_BYTES:
+            self._values = tuple(self._iter_mapped())
+            self._rows_by_key = {}
+            for row, value in enumerate(self._values):
+                self._rows_by_key.setdefault(value if self.columns == 1 else value[0], row)
+
+    def __len__(self):
+        return self.rows
+
+    def _bytes(self, position):
+        start, end = UINT32_PAIR.unpack_from(self._data, self._offsets + position * UINT32.size)
+        return self._data[self._text + start:self._text + end - 1]
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.rows
+        if not 0 <= row < self.rows:
+            raise IndexError(row)
+        if self._values is not None:
+            return self._values[row]
+        values = tuple(self._bytes(row * self.columns + column).decode('utf-8') for column in range(self.columns))
+        return values[0] if self.columns == 1 else values
+
+    def __iter__(self):
+        if self._values is not None:
+            return iter(self._values)
+        return self._iter_mapped()
+
+    def _iter_mapped(self):
+        if not self.rows:
+            return iter(())
+        strings = self._data[self._text:self._text_end - 1].decode('utf-8').split(SEPARATOR)
+        if self.columns == 1:
+            return iter(strings)
+        return zip(*[iter(strings)] * self.columns)
+
+    def _find(self, key):
+        """Returns the row whose first column is `key`, or -1"""
+        if self._rows_by_key is not None:
+            return self._rows_by_key.get(key, -1)
+        # Most lookups miss; a UTF-8 key has at least as many bytes as characters
+        if not isinstance(key, str) or not self.rows or len(key) > self._key_lengths[1]:
+            return -1
+        key = key.encode('utf-8')
+        if len(key) < self._key_lengths[0] or len(key) > self._key_lengths[1]:
+            return -1
+        mask = self._slots - 1
+        slot = zlib.crc32(key) & mask
+        while True:
+            row, = UINT32.unpack_from(self._data, self._index + slot * UINT32.size)
+            if not row:
+                return -1
+            if self._bytes((row - 1) * self.columns) == key:
+                return row - 1
+            slot = (slot + 1) & mask
+
+    def __contains__(self, key):
+        if self._rows_by_key is not None:
+            return key in self._rows_by_key
+        return self._find(key) != -1
+
+    def get(self, key, default=None):
+        """Returns the second column of the row with this key"""
+        row = self._find(key)
+        return default if row == -1 else self[row][1]
+
+
+class ReferenceTables:
+    """
+    A compiled reference file mapped read-only into memory
+
+    Every process that opens the same file shares its pages through the
+    page cache, so the lookup data is held in memory once however many
+    workers there are. Tables are attributes named after the source keys.
+    Objects built from the tables (such as compiled regexes) can be cached
+    with derived(); they are rebuilt when a new file is swapped in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.stat = os.fstat(file.fileno())
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, directory_length = TABLES_HEADER.unpack_from(self._map)
+        if magic != TABLES_MAGIC:
+            raise ValueError(f'{path} is not a compiled reference table file')
+        base = TABLES_HEADER.size + directory_length
+        self.directory = json.loads(self._map[TABLES_HEADER.size:base])
+        self.version = self.directory['version']
+        self.tables = {name: MappedTable(self._map, base, info) for name, info in self.directory['tables'].items()}
+        self._derived = {}
+        self._derived_lock = threading.Lock()
+        for name, table in self.tables.items():
+            if name in RESERVED_TABLE_NAMES or name.startswith('_'):
+                raise ValueError(f'{path}: table name {name!r} is reserved')
+            setattr(self, name, table)
+
+    def derived(self, name, build):
+        """Returns build(self), built once per compiled file"""
+        value = self._derived.get(name)
+        if value is None:
+            with self._derived_lock:
+                value = self._derived.get(name)
+                if value is None:
+                    value = self._derived[name] = build(self)
+        return value
+
+
+def load_source(source_path):
+    """
+    Reads the table source: a JSON object of table name to a list of
+    strings, or a list of [key, value] pairs for lookup tables
+    """
+    with open(source_path, encoding='utf-8') as file:
+        source = json.load(file)
+    tables = {}
+    for name, rows in source.items():
+        if name.startswith('_'):
+            continue  # Comments
+        if not name.isidentifier() or name in RESERVED_TABLE_NAMES:
+            raise ValueError(f'Table name {name!r} is not an identifier or is reserved')
+        if not isinstance(rows, list):
+            raise ValueError(f'Table {name!r} is not a list')
+        columns = 2 if rows and isinstance(rows[0], list) else 1
+        for row in rows:
+            if (columns == 1 and not isinstance(row, str)) or (columns == 2 and not (
+                    isinstance(row, list) and len(row) == 2 and all(isinstance(value, str) for value in row))):
+                raise ValueError(f'Table {name!r} mixes strings and [key, value] pairs')
+            if SEPARATOR in (row if columns == 1 else ''.join(row)):
+                raise ValueError(f'Table {name!r} contains a NUL character')
+        tables[name] = (columns, rows)
+    return tables
+
+
+def compile_tables(source_path, output_path):
+    """
+    Compiles the table source into the binary format read by ReferenceTables
+
+    The file is written next to the output and renamed over it, so
+    processes see either the old or the new tables, never a partial file;
+    mappings of the old file stay valid until they are dropped.
+    Returns the version (a checksum of the content) of the new file.
+    """
+    tables = load_source(source_path)
+    directory = {'tables': {}}
+    content = bytearray()
+    for name, (columns, rows) in tables.items():
+        text = bytearray()
+        offsets = array('I', [0])
+        for row in rows:
+            for value in ([row] if columns == 1 else row):
+                text += value.encode('utf-8') + SEPARATOR.encode('utf-8')
+                offsets.append(len(text))
+        if offsets.itemsize != UINT32.size:
+            raise ValueError('Unsupported platform: unsigned int is not 4 bytes')
+
+        # Linear probing; the first row with a key wins, as in a scan
+        slots = _hash_slots(len(rows))
+        index = array('I', [0]) * slots
+        for row_number, row in enumerate(rows):
+            key = (row if columns == 1 else row[0]).encode('utf-8')
+            slot = zlib.crc32(key) & (slots - 1)
+            while index[slot]:
+                if (rows[index[slot] - 1] if columns == 1 else rows[index[slot] - 1][0]).encode('utf-8') == key:
+                    break
+                slot = (slot + 1) & (slots - 1)
+            else:
+                index[slot] = row_number + 1
+
+        key_lengths = [len((row if columns == 1 else row[0]).encode('utf-8')) for row in rows] or [0]
+        info = {
+            'rows': len(rows),
+            'columns': columns,
+            'slots': slots,
+            'key_lengths': [min(key_lengths), max(key_lengths)],
+            'offsets': len(content),
+        }
+        content += _to_little_endian(offsets).tobytes()
+        info['index'] = len(content)
+        content += _to_little_endian(index).tobytes()
+        info['text'] = len(content)
+        info['text_length'] = len(text)
+        content += text
+        directory['tables'][name] = info
+    directory['version'] = hashlib.sha256(content).hexdigest()[:16]
+    directory_json = json.dumps(directory).encode('utf-8')
+
+    output_directory = os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(output_directory, exist_ok=True)
+    descriptor, temp_path = tempfile.mkstemp(dir=output_directory, prefix='.reference-')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(TABLES_HEADER.pack(TABLES_MAGIC, len(directory_json)))
+            file.write(directory_json)
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return directory['version']
+
+
+def _to_little_endian(values):
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def _setting(name, default):
+    # The parser also runs outside Django (scripts, the parse pool)
+    try:
+        return getattr(settings, name, default)
+    except ImproperlyConfigured:
+        return default
+
+
+class TableLoader:
+    """
+    Keeps the current ReferenceTables of a process up to date
+
+    At most every `check_interval` seconds, the compiled file is recompiled
+    if its source is newer, and mapped again if another process has swapped
+    in a new file. Callers holding the previous tables keep a valid mapping.
+    """
+
+    def __init__(self, source_path, path, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.source_path = source_path
+        self.path = path
+        self.check_interval = check_interval
+        self.reloads = 0
+        self.last_error = None
+        self._tables = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns the current tables"""
+        tables = self._tables
+        if tables is not None and time.monotonic() < self._next_check:
+            return tables
+        with self._lock:
+            if self._tables is None or time.monotonic() >= self._next_check:
+                self._refresh()
+            return self._tables
+
+    def _refresh(self):
+        self._next_check = time.monotonic() + self.check_interval
+        try:
+            compiled = os.stat(self.path)
+        except FileNotFoundError:
+            compiled = None
+        if self.source_path and os.path.exists(self.source_path) and (
+                compiled is None or os.stat(self.source_path).st_mtime > compiled.st_mtime):
+            try:
+                compile_tables(self.source_path, self.path)
+                compiled = os.stat(self.path)
+                self.last_error = None
+            except (OSError, ValueError) as e:
+                # Keep parsing with the tables we have rather than failing every statement
+                self.last_error = f'{self.source_path}: {e}'
+                if compiled is None:
+                    raise
+
+        current = self._tables
+        if current is None or (current.stat.st_ino, current.stat.st_mtime_ns) != (compiled.st_ino, compiled.st_mtime_ns):
+            self._tables = ReferenceTables(self.path)
+            if current is not None:
+                self.reloads += 1
+
+    def stats(self):
+        """Returns the version of the current tables and how often they were reloaded"""
+        try:
+            tables = self.get()
+        except (OSError, ValueError) as e:
+            tables, self.last_error = None, str(e)
+        return {
+            'path': self.path,
+            'version': tables.version if tables else None,
+            'tables': {name: len(table) for name, table in tables.tables.items()} if tables else {},
+            'reloads': self.reloads,
+            'last_error': self.last_error,
+        }
+
+
+_loader = None
+_loader_lock = threading.Lock()
+
+
+def get_table_loader():
+    """
+    Returns the process-wide TableLoader, configured from settings
+    """
+    global _loader
+    with _loader_lock:
+        if _loader is None:
+            _loader = TableLoader(
+                _setting('REFERENCE_TABLES_SOURCE', DEFAULT_SOURCE),
+                _setting('REFERENCE_TABLES_PATH', DEFAULT_PATH),
+                _setting('REFERENCE_TABLES_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL),
+            )
+        return _loader
+
+
+def get_reference_tables():
+    """Returns the current reference tables of this process"""
+    loader = _loader or get_table_loader()
+    return loader.get()
@@ -0,0 +1,145 @@
+import csv
+import os
+from contextlib import nullcontext
+
+from .parser import (OUTPUT_FIELDS, RAW_FIELDS, RULE_FAMILIES, SectionTracker, apply_currency_rules,
+                     extract_location, rule_fingerprints)
+from .provenance import PROVENANCE_SUFFIX, RULES_SUFFIX, ProvenanceWriter, read_provenance, read_rules_summary
+from .reftables import get_reference_tables
+from .rowindex import INDEX_SUFFIX, IndexedCsvWriter, RowIndex, open_standardized
+
+# Suffix of the files a re-normalization writes before swapping them in
+RENORMALIZING_SUFFIX = '.renormalizing'
+
+
+def _location_columns(raw, sections, tables):
+    return {'Location': extract_location(raw['description'], tables)}
+
+
+def _currency_columns(raw, sections, tables):
+    return dict(zip(('Currency', 'Debit', 'Credit'), apply_currency_rules(raw, tables)))
+
+
+def _name_columns(raw, sections, tables):
+    return {'CardName': sections.name}
+
+
+def _section_columns(raw, sections, tables):
+    return {'Transaction': sections.type}
+
+
+# Recomputes the columns of each rule family from a row's raw fields, the
+# replayed section tracker and the reference tables
+RECOMPUTE = {
+    'location': _location_columns,
+    'currency': _currency_columns,
+    'name': _name_columns,
+    'section': _section_columns,
+}
+
+# Families that need every line of the statement replayed through a SectionTracker
+SECTION_FAMILIES = frozenset(['name', 'section'])
+
+
+def _recompute(row, raw, sections, tables, families, stats):
+    """Recomputes the columns of the given families in a row, counting what changed"""
+    changed = False
+    for family in families:
+        stats['recomputed'][family] += 1
+        for column, value in RECOMPUTE[family](raw, sections, tables).items():
+            if str(value) != row[column]:
+                stats['changed'][column] += 1
+                changed = True
+            row[column] = value
+    if changed:
+        stats['changed_rows'] += 1
+
+
+def outdated_families(output_path, families=None, tables=None):
+    """
+    Returns the rule families some rows of an output were produced with an
+    older version of, or None if the output has no provenance
+    """
+    rule_sets = read_rules_summary(output_path)
+    if rule_sets is None:
+        return None
+    current = rule_fingerprints(tables)
+    return [family for family in (families or RULE_FAMILIES)
+            if any(rules.get(family) != current[family] for rules in rule_sets)]
+
+
+def renormalize_output(output_path, families=None, swap_lock=None):
+    """
+    Re-applies changed rules to a standardized output from its provenance
+
+    Only the rows whose fingerprint for a family differs from the current
+    one are recomputed, and only that family's columns; dates and
+    descriptions are copied as they are, so no statement is parsed again.
+    Name and section rules replay the statement's lines through a
+    SectionTracker. The new files are swapped in while holding `swap_lock`
+    (for stored outputs, the artifact's lock), so readers never see an
+    output with the index or provenance of another version. Returns
+    statistics of the run.
+    """
+    stats = {'rows': 0, 'recomputed': {}, 'changed_rows': 0, 'changed': {}}
+    # One snapshot of the tables for the whole output, as for a parse
+    tables = get_reference_tables()
+    stale = outdated_families(output_path, families, tables)
+    if stale is None:
+        raise ValueError(f'{output_path} has no provenance to re-normalize from')
+    if not stale:
+        return stats
+    stats['recomputed'] = {family: 0 for family in stale}
+    stats['changed'] = {column: 0 for family in stale for column in RULE_FAMILIES[family]['columns']}
+
+    current = rule_fingerprints(tables)
+    bank_format, delimiter, lines = read_provenance(output_path)
+    raw_fields = RAW_FIELDS[bank_format]
+    sections = SectionTracker(delimiter, tables=tables) if SECTION_FAMILIES.intersection(stale) else None
+
+    temp_path = output_path + RENORMALIZING_SUFFIX
+    try:
+        with open_standardized(output_path) as old_file:
+            with IndexedCsvWriter(temp_path, OUTPUT_FIELDS, compression=RowIndex(output_path).compression) as writer:
+                with ProvenanceWriter(temp_path) as recorder:
+                    old_rows = csv.DictReader(old_file)
+                    recorder.start(bank_format, delimiter)
+                    for row_number, rules, cells in lines:
+                        # Same order as StatementRowParser.feed: sections first, then the row
+                        if sections is not None:
+                            sections.update(cells)
+                        if row_number is None:
+                            recorder.record(cells)
+                            continue
+
+                        row = next(old_rows, None)
+                        if row is None:
+                            raise ValueError(f'{output_path} has fewer rows than its provenance')
+                        outdated = [family for family in stale if rules.get(family) != current[family]]
+                        if outdated:
+                            _recompute(row, raw_fields(cells), sections, tables, outdated, stats)
+                            rules = dict(rules, **{family: current[family] for family in outdated})
+
+                        recorder.set_rules(rules)
+                        recorder.record(cells, row)
+                        writer.writerow(row)
+                        stats['rows'] += 1
+                    if next(old_rows, None) is not None:
+                        raise ValueError(f'{output_path} has more rows than its provenance')
+    except BaseException:
+        for suffix in ('', INDEX_SUFFIX, PROVENANCE_SUFFIX, RULES_SUFFIX):
+            if os.path.exists(temp_path + suffix):
+                os.remove(temp_path + suffix)
+        raise
+
+    # Swap the new files in; the output itself only if a value changed
+    suffixes = [PROVENANCE_SUFFIX, RULES_SUFFIX]
+    if stats['changed_rows']:
+        suffixes = ['', INDEX_SUFFIX] + suffixes
+    else:
+        os.remove(temp_path)
+        os.remove(temp_path + INDEX_SUFFIX)
+    with swap_lock or nullcontext():
+        for suffix in suffixes:
+            os.replace(temp_path + suffix, output_path + suffix)
+    return stats
@@ -0,0 +1,364 @@
+import csv
+import gzip
+import io
+import json
+import os
+import struct
+import sys
+from array import array
+
+from .compression import GZIP_MAGIC, SeekableGzipWriter, detect_compression, read_gzip_range
+
+# Sidecar index written next to every standardized output
+INDEX_SUFFIX = '.idx'
+
+# Layout: magic, row count, block count, length of the JSON info and of the
+# sections, the JSON info (compression), then row_count + 1 little-endian
+# uint64 byte offsets into the uncompressed CSV (the last one is the end of
+# the file), the seek blocks of a compressed output as pairs of uint64
+# (uncompressed offset, compressed offset), and finally the sections as JSON
+INDEX_MAGIC = b'NRIDX3\x00\x00'
+INDEX_HEADER = struct.Struct('<8sQQII')
+OFFSET_SIZE = 8
+BLOCK = struct.Struct('<QQ')
+
+# Offsets, seek blocks and finished sections of an output that is still
+# being written in several sessions
+PENDING_OFFSETS_SUFFIX = '.offsets'
+PENDING_BLOCKS_SUFFIX = '.blocks'
+PENDING_SECTIONS_SUFFIX = '.sections'
+
+
+class IndexedCsvWriter:
+    """
+    Writes a CSV file while recording the byte offset of every row
+
+    On close, a sidecar index is written at `<csv path>.idx` with the offset
+    of each row and the runs of rows that belong to the same card holder and
+    section, so any page or section can later be read with a single seek.
+    The CSV itself is byte-for-byte what csv.DictWriter would produce, or its
+    gzip compressed form with compression='gzip' (see SeekableGzipWriter).
+    """
+
+    def __init__(self, file_path, fieldnames, card_field='CardName', section_field='Transaction', compression=None):
+        if compression not in (None, 'gzip'):
+            raise ValueError(f'Unsupported output compression: {compression}')
+        self.file_path = file_path
+        self.fieldnames = fieldnames
+        self.card_field = card_field
+        self.section_field = section_field
+        self.compression = compression
+        self.offsets = array('Q')
+        self.sections = []
+        self._file = None
+        self._sink = None
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._position = 0
+        # Rows whose offsets are no longer in self.offsets (see ResumableCsvWriter)
+        self._row_count = 0
+
+    def __enter__(self):
+        self._file = open(self.file_path, 'wb')
+        self._sink = SeekableGzipWriter(self._file) if self.compression else self._file
+        self._write_line(self.fieldnames)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        blocks = None
+        if exc_type is None and self.compression:
+            self._sink.finish()
+            blocks = self._sink.blocks
+        self._file.close()
+        if exc_type is None:
+            self.offsets.append(self._position)
+            write_index(self.file_path + INDEX_SUFFIX, self.offsets, self.sections, self.compression, blocks)
+        return False
+
+    def _write_line(self, values):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._writer.writerow(values)
+        data = self._buffer.getvalue().encode('utf-8')
+        self._sink.write(data)
+        self._position += len(data)
+
+    def restart(self):
+        """
+        Discards every row written so far (a parse that is retried with
+        another bank format)
+        """
+        if not self.offsets:
+            return
+        self._file.seek(0)
+        self._file.truncate()
+        self._sink = SeekableGzipWriter(self._file) if self.compression else self._file
+        self.offsets = array('Q')
+        self.sections = []
+        self._position = 0
+        self._write_line(self.fieldnames)
+
+    def writerow(self, row):
+        row_number = self._row_count + len(self.offsets)
+        card, section = row.get(self.card_field, ''), row.get(self.section_field, '')
+        if not self.sections or (self.sections[-1]['card'], self.sections[-1]['type']) != (card, section):
+            self.sections.append({'card': card, 'type': section, 'first_row': row_number, 'rows': 0})
+        self.sections[-1]['rows'] += 1
+
+        self.offsets.append(self._position)
+        self._write_line([row.get(field, '') for field in self.fieldnames])
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+class ResumableCsvWriter(IndexedCsvWriter):
+    """
+    An IndexedCsvWriter whose output is written over several sessions
+
+    Each session appends rows to the CSV, their offsets to
+    `<csv path>.offsets`, the seek blocks to `<csv path>.blocks` and the
+    finished sections to `<csv path>.sections`; get_state() returns what the
+    next session needs to carry on, which stays the same size however many
+    rows are written. finish() turns the collected files into the normal index.
+    """
+
+    def __init__(self, file_path, fieldnames, state=None, **kwargs):
+        if state is not None:
+            kwargs['compression'] = state['compression']
+        super().__init__(file_path, fieldnames, **kwargs)
+        self._resuming = state is not None
+        self._sink_state = None
+        self._block_count = 0
+        self._sections_size = 0
+        if state is not None:
+            self._position = state['position']
+            self.sections = [state['section']] if state['section'] else []
+            self._row_count = state['rows']
+            self._sink_state = state['sink']
+            self._block_count = state['blocks']
+            self._sections_size = state['sections_size']
+
+    def __enter__(self):
+        if not self._resuming:
+            super().__enter__()
+            for suffix in (PENDING_OFFSETS_SUFFIX, PENDING_BLOCKS_SUFFIX, PENDING_SECTIONS_SUFFIX):
+                with open(self.file_path + suffix, 'wb'):
+                    pass
+            return self
+        self._file = open(self.file_path, 'r+b')
+        # Drop anything a failed session wrote after its last saved state
+        end = self._sink_state['compressed'] if self.compression else self._position
+        self._file.truncate(end)
+        self._file.seek(end)
+        self._sink = SeekableGzipWriter(self._file, self._sink_state) if self.compression else self._file
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        blocks = []
+        if exc_type is None and self.compression:
+            self._sink_state = self._sink.get_state()
+            blocks = self._sink.blocks
+        self._file.close()
+        if exc_type is None:
+            _append_pending(self.file_path + PENDING_OFFSETS_SUFFIX, self._row_count * OFFSET_SIZE,
+                            _to_little_endian(self.offsets).tobytes())
+            self._row_count += len(self.offsets)
+            self.offsets = array('Q')
+            # Only the last section can still grow
+            _append_pending(self.file_path + PENDING_BLOCKS_SUFFIX, self._block_count * BLOCK.size,
+                            b''.join(BLOCK.pack(*block) for block in blocks))
+            self._block_count += len(blocks)
+            self._sections_size = _append_pending(
+                self.file_path + PENDING_SECTIONS_SUFFIX, self._sections_size,
+                b''.join(json.dumps(section).encode('utf-8') + b'\n' for section in self.sections[:-1]))
+            self.sections = self.sections[-1:]
+        return False
+
+    def get_state(self):
+        return {
+            'position': self._position,
+            'section': self.sections[-1] if self.sections else None,
+            'sections_size': self._sections_size,
+            'rows': self._row_count,
+            'blocks': self._block_count,
+            'compression': self.compression,
+            'sink': self._sink_state,
+        }
+
+    @staticmethod
+    def finish(file_path, state):
+        """Writes the index for a completed output and removes the pending files"""
+        blocks = None
+        if state['compression']:
+            with open(file_path, 'r+b') as file:
+                file.truncate(state['sink']['compressed'])
+                file.seek(state['sink']['compressed'])
+                SeekableGzipWriter(file, state['sink']).finish()
+            with open(file_path + PENDING_BLOCKS_SUFFIX, 'rb') as file:
+                blocks = [list(block) for block in BLOCK.iter_unpack(file.read(state['blocks'] * BLOCK.size))]
+            # The final block is empty, so it never needs to be a seek point
+            if len(blocks) > 1 and blocks[-1][0] == state['sink']['size']:
+                blocks.pop()
+
+        with open(file_path + PENDING_OFFSETS_SUFFIX, 'rb') as file:
+            offsets = array('Q')
+            offsets.frombytes(file.read(state['rows'] * OFFSET_SIZE))
+        _to_little_endian(offsets)  # Swaps back to native order on big-endian machines
+        offsets.append(state['position'])
+        with open(file_path + PENDING_SECTIONS_SUFFIX, 'rb') as file:
+            sections = [json.loads(line) for line in file.read(state['sections_size']).splitlines()]
+        if state['section']:
+            sections.append(state['section'])
+        write_index(file_path + INDEX_SUFFIX, offsets, sections, state['compression'], blocks)
+        for suffix in (PENDING_OFFSETS_SUFFIX, PENDING_BLOCKS_SUFFIX, PENDING_SECTIONS_SUFFIX):
+            os.remove(file_path + suffix)
+
+
+def _append_pending(path, size, data):
+    """
+    Appends to a pending file of a ResumableCsvWriter after its first `size`
+    bytes, dropping anything a failed session wrote past them
+    Returns the new size.
+    """
+    with open(path, 'r+b') as file:
+        file.truncate(size)
+        file.seek(size)
+        file.write(data)
+    return size + len(data)
+
+
+def _to_little_endian(offsets):
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    return offsets
+
+
+def write_index(index_path, offsets, sections, compression=None, blocks=None):
+    """
+    Writes a row index; `offsets` holds the start of every row plus the end of the file
+    For compressed outputs, `blocks` are the seek points of the compressed file
+    """
+    info_json = json.dumps({'compression': compression}, separators=(',', ':')).encode('utf-8')
+    sections_json = json.dumps(sections, separators=(',', ':')).encode('utf-8')
+    offsets = array('Q', offsets)
+    if offsets.itemsize != OFFSET_SIZE:
+        raise ValueError('Unsupported platform: unsigned long long is not 8 bytes')
+    _to_little_endian(offsets)
+    blocks = blocks or []
+    with open(index_path, 'wb') as file:
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(offsets) - 1, len(blocks), len(info_json),
+                                     len(sections_json)))
+        file.write(info_json)
+        offsets.tofile(file)
+        for block in blocks:
+            file.write(BLOCK.pack(*block))
+        file.write(sections_json)
+
+
+class BlockTable:
+    """
+    The seek blocks of a row index, read from an open index file one entry
+    at a time, so finding a block costs a few seeks whatever the output size
+    """
+
+    def __init__(self, file, start, count):
+        self._file = file
+        self._start = start
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        self._file.seek(self._start + index * BLOCK.size)
+        return BLOCK.unpack(self._file.read(BLOCK.size))
+
+
+class RowIndex:
+    """
+    Reads pages of a standardized output through its sidecar index
+    Only the index header and the requested rows are read from disk; the
+    sections are read the first time they are used.
+    """
+
+    def __init__(self, csv_path, index_path=None):
+        self.csv_path = csv_path
+        self.index_path = index_path or csv_path + INDEX_SUFFIX
+        self._sections = None
+        with open(self.index_path, 'rb') as file:
+            header = file.read(INDEX_HEADER.size)
+            if len(header) != INDEX_HEADER.size or header[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+                raise ValueError(f'{self.index_path} is not a row index')
+            magic, self.row_count, block_count, info_length, sections_length = INDEX_HEADER.unpack(header)
+            info = json.loads(file.read(info_length).decode('utf-8'))
+        self.compression = info['compression']
+        self._offsets_start = INDEX_HEADER.size + info_length
+        self._blocks_start = self._offsets_start + (self.row_count + 1) * OFFSET_SIZE
+        self._block_count = block_count
+        self._sections_start = self._blocks_start + block_count * BLOCK.size
+        self._sections_length = sections_length
+
+    @property
+    def sections(self):
+        if self._sections is None:
+            with open(self.index_path, 'rb') as file:
+                file.seek(self._sections_start)
+                self._sections = json.loads(file.read(self._sections_length).decode('utf-8'))
+        return self._sections
+
+    def cards(self):
+        """Returns each card holder with the first row of their first section"""
+        cards = {}
+        for section in self.sections:
+            cards.setdefault(section['card'], section['first_row'])
+        return cards
+
+    def _offsets(self, start, end):
+        """Reads the byte offsets of rows start..end (inclusive)"""
+        with open(self.index_path, 'rb') as file:
+            file.seek(self._offsets_start + start * OFFSET_SIZE)
+            return struct.unpack(f'<{end - start + 1}Q', file.read((end - start + 1) * OFFSET_SIZE))
+
+    def read_rows(self, start, count):
+        """
+        Returns up to `count` rows as dicts, starting at row number `start`
+        """
+        start = max(0, min(start, self.row_count))
+        end = min(start + max(count, 0), self.row_count)
+        if end <= start:
+            return []
+
+        header_end, = self._offsets(0, 0)
+        first, last = self._offsets(start, end)[::end - start]
+        with open(self.csv_path, 'rb') as file:
+            if self.compression:
+                with open(self.index_path, 'rb') as index_file:
+                    blocks = BlockTable(index_file, self._blocks_start, self._block_count)
+                    header = read_gzip_range(file, blocks, 0, header_end).decode('utf-8-sig')
+                    data = read_gzip_range(file, blocks, first, last).decode('utf-8')
+            else:
+                header = file.read(header_end).decode('utf-8-sig')
+                file.seek(first)
+                data = file.read(last - first).decode('utf-8')
+
+        fieldnames = next(csv.reader([header]))
+        return list(csv.DictReader(io.StringIO(data, newline=''), fieldnames=fieldnames))
+
+    def read_page(self, page, page_size):
+        """Returns the rows of a 1-based page"""
+        return self.read_rows((max(page, 1) - 1) * page_size, page_size)
+
+
+def open_standardized(file_path):
+    """
+    Opens a standardized output for reading as text, compressed or not
+    """
+    with open(file_path, 'rb') as file:
+        compressed = detect_compression(file.read(len(GZIP_MAGIC))) == 'gzip'
+    if compressed:
+        return gzip.open(file_path, 'rt', newline='', encoding='utf-8-sig')
+    return open(file_path, 'r', newline='', encoding='utf-8-sig')
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import time
+
+from .parser import parse_csv_statement
+
+# One tiny statement per bank format, covering names, both section types,
+# credits and foreign currency so every code path is touched once
+WARMUP_SAMPLES = {
+    'hdfc': (
+        ',Domestic Transactions,\n'
+        'Date,Transaction Description,Amount\n'
+        ',Rahul,\n'
+        '12-01-2018,STIC TRAVELS PVT LTD DELHI,32256 cr\n'
+        '13-01-2018,FLIPKART INTERNET PRIVATE BANGALORE,211687\n'
+        ',International Transactions,\n'
+        ',Ritu,\n'
+        '14-01-2018,HEALTHGUARD LIMITED KATUNAYAKE USD,5 cr\n'
+    ),
+    'icici': (
+        ',,Domestic Transactions,,\n'
+        '"Date","Transaction Description",Debit,Credit,\n'
+        ',,Rahul,,\n'
+        '12-03-2018,Amazon Cash Back Jan 18 Hissar,213,,\n'
+        ',,International Transactions,,\n'
+        '15-03-2018,UBER BV AMSTERDAM EUR,,52\n'
+    ),
+    'axis': (
+        ',,Domestic Transactions,\n'
+        '"Date",Debit,Credit,Transaction Details\n'
+        ',,Rahul,\n'
+        '28-01-2018,1099,,INDIAN RAILWAY CATERINGNEW DELHI\n'
+        ',,International Transactions,\n'
+        '02-02-2018,,12,ALIEXPRESS BERLIN USD\n'
+    ),
+    'idfc': (
+        ',,,,Domestic Transactions,\n'
+        '"Transaction Details","Date",Amount,,,\n'
+        ',Rahul,,,,\n'
+        '"JUNOON RESTRO GURGAON",12-13-2017,1255,,,\n'
+        '"POONAM SERVICE STATION GURGAON",12-16-2017,17 Cr,,,\n'
+        ',,,,International Transactions,\n'
+        '"STEAM GAMES NEWYORK USD",12-20-2017,20,,,\n'
+    ),
+}
+
+
+def warm_up():
+    """
+    Runs each bank parser once on a tiny built-in statement so that lazy
+    imports, regex compilation and dateutil's lookup tables are done before
+    the first real upload. Returns the time taken per bank in milliseconds.
+    """
+    timings = {}
+    with tempfile.TemporaryDirectory(prefix='warmup-') as temp_dir:
+        for bank, content in WARMUP_SAMPLES.items():
+            # The bank name in the filename picks the parser
+            file_path = os.path.join(temp_dir, f'{bank}-warmup.csv')
+            with open(file_path, 'w', encoding='utf-8') as file:
+                file.write(content)
+            started = time.perf_counter()
+            parse_csv_statement(file_path)
+            timings[bank] = round((time.perf_counter() - started) * 1000, 2)
+    return timings
+
+
+def warm_up_web(start_pool=True):
+    """
+    Warms up the web process: loads the URLconf and templates, runs every
+    bank parser once and, with start_pool=True, starts the parse processes
+    (see workers.start_parse_pool). Returns the timings of each step in
+    milliseconds.
+    """
+    from django.template.loader import get_template
+    from django.urls import get_resolver
+
+    timings = {}
+    started = time.perf_counter()
+    get_resolver().url_patterns
+    for template_name in ('upload.html', 'result.html'):
+        get_template(template_name)
+    timings['django'] = round((time.perf_counter() - started) * 1000, 2)
+    timings.update(warm_up())
+    if start_pool:
+        from .workers import start_parse_pool
+        timings['parse_pool'] = start_parse_pool()
+    return timings
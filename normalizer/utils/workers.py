@@ -0,0 +1,196 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+from .artifacts import ArtifactStore
+from .parser import standardize_statement
+from .warmup import warm_up
+
+
+def standardize_artifact(root, input_id, output_id, compression=None):
+    """
+    Standardizes a stored statement into its output artifact
+    Both artifacts stay locked meanwhile so the sweeper leaves them alone.
+    Only takes plain arguments so that it can run in the parse process pool.
+    """
+    store = ArtifactStore(root)
+    with store.lock(input_id), store.lock(output_id):
+        return standardize_statement(store.path(input_id), store.path(output_id), compression)
+
+
+class ParserBusy(Exception):
+    """Raised when too many statements are already waiting to be parsed"""
+
+
+class ParseAdmission:
+    """
+    Admission control for CPU-bound statement parsing
+
+    At most `max_parallel` parses run at once, on a process pool of the same
+    size so they don't fight over the GIL. Up to `max_waiting` more requests
+    may queue for a slot; anything beyond that is turned away with ParserBusy
+    instead of piling up behind the pool.
+
+    Slots are counted under a lock rather than with an asyncio.Semaphore:
+    under a sync (WSGI) server every async view runs in its own event loop,
+    on its own thread, and the limits must hold across all of them.
+    """
+
+    def __init__(self, max_parallel, max_waiting):
+        self.max_parallel = max_parallel
+        self.max_waiting = max_waiting
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self._waiters = deque()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_parallel, mp_context=_pool_context())
+            return self._executor
+
+    def start(self, warm_up=None):
+        """
+        Starts the pool's processes now instead of on the first parse, and
+        runs `warm_up` in them; only call it in a process that won't fork
+        """
+        executor = self._get_executor()
+        # One task per process, so that every process is started
+        futures = [executor.submit(warm_up or _ready) for _ in range(self.max_parallel)]
+        for future in futures:
+            future.result()
+
+    def _reset_executor(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    async def _acquire(self, loop):
+        with self._lock:
+            if self.running < self.max_parallel and not self._waiters:
+                self.running += 1
+                return
+            if len(self._waiters) >= self.max_waiting:
+                self.rejected += 1
+                raise ParserBusy(f'{len(self._waiters)} statements are already waiting to be processed')
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                handed_over = waiter not in self._waiters
+                if not handed_over:
+                    self._waiters.remove(waiter)
+            if handed_over:
+                # The slot was passed to us as we were cancelled; pass it on
+                self._release()
+            raise
+
+    def _release(self):
+        with self._lock:
+            while self._waiters:
+                # Hand the slot straight to the next waiter, on its own loop
+                loop, future = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(_wake, future)
+                    return
+                except RuntimeError:
+                    continue  # Its loop is gone
+            self.running -= 1
+
+    async def run(self, func, *args):
+        """
+        Runs func(*args) in the parse pool once a slot is free
+        Raises ParserBusy if the waiting queue is already full
+        """
+        loop = asyncio.get_running_loop()
+        await self._acquire(loop)
+        try:
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM killed); start a fresh pool next time
+            self._reset_executor()
+            raise
+        finally:
+            with self._lock:
+                self.completed += 1
+            self._release()
+
+    def stats(self):
+        """Returns the current queue depth and counters"""
+        with self._lock:
+            return {
+                'running': self.running,
+                'waiting': len(self._waiters),
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'max_parallel': self.max_parallel,
+                'max_waiting': self.max_waiting,
+            }
+
+
+def _ready():
+    return True
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _pool_context():
+    """
+    Start method of the parse pool: not fork, because the web worker has
+    threads by then and a child forked while one of them holds a lock
+    (reference tables, artifact store) would deadlock on it. The fork server
+    preloads the parser so children still start warm.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['normalizer.utils.parser', 'normalizer.utils.chunked'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+_admission = None
+
+
+def start_parse_pool():
+    """
+    Starts and warms up the parse processes of this web process, so the
+    first upload doesn't pay for them. Under gunicorn this runs in each
+    worker (see gunicorn.conf.py), never in the master that forks them.
+    Returns the time taken in milliseconds.
+    """
+    started = time.perf_counter()
+    get_parse_admission().start(warm_up)
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+def get_parse_admission():
+    """
+    Returns the process-wide ParseAdmission, configured from settings
+    """
+    global _admission
+    if _admission is None:
+        max_parallel = getattr(settings, 'PARSE_MAX_PARALLEL', None) or os.cpu_count() or 1
+        max_waiting = getattr(settings, 'PARSE_MAX_WAITING', 256)
+        _admission = ParseAdmission(max_parallel, max_waiting)
+    return _admission
@@ -1,83 +1,364 @@
 import os
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, FileResponse
+from django.urls import reverse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
 from django.conf import settings
-from django.core.files.storage import FileSystemStorage
 from django.contrib import messages
+from asgiref.sync import sync_to_async
 import csv
 import io
 import os.path
 import re
 
-from .utils.parser import standardize_statement, detect_bank_format
+from .utils.parser import detect_bank_format, OUTPUT_FIELDS
+from .utils.workers import get_parse_admission, standardize_artifact, ParserBusy
+from .utils.artifacts import get_artifact_store, ArtifactNotFound
+from .utils.rowindex import RowIndex
+from .utils.reftables import get_table_loader
+from .utils.compression import is_supported_upload, supported_suffixes, iter_chunks, iter_gunzipped
+from .utils.chunked import (init_upload, append_chunk, mark_complete, upload_status,
+                            start_parse, advance_parse, finish_upload, ChunkError)
+
+# Rows shown per page of the result page preview
+PREVIEW_PAGE_SIZE = 20
+MAX_PREVIEW_PAGE_SIZE = 500
+
+# Same check as django.middleware.gzip.GZipMiddleware
+ACCEPTS_GZIP_PATTERN = re.compile(r'\bgzip\b')
 
 def home(request):
     """Home page view with file upload form"""
     return render(request, 'upload.html')
 
-def upload_file(request):
-    """Handle file upload and processing"""
-    if request.method == 'POST' and request.FILES.get('statement_file'):
-        # Get uploaded file
-        uploaded_file = request.FILES['statement_file']
-        
-        # Check if it's a CSV
-        if not uploaded_file.name.endswith('.csv'):
-            messages.error(request, 'Please upload a CSV file')
-            return redirect('home')
-        
-        # Save the uploaded file
-        fs = FileSystemStorage()
-        input_filename = fs.save(uploaded_file.name, uploaded_file)
-        input_file_path = os.path.join(settings.MEDIA_ROOT, input_filename)
-        
-        # Detect bank format for naming
-        bank_format = detect_bank_format(input_file_path).capitalize()
+def save_upload(uploaded_file):
+    """
+    Saves an uploaded statement in the artifact store and reserves its output
+    Returns a dict describing both artifacts
+    """
+    store = get_artifact_store()
+    input_id = store.create(uploaded_file.name, 'upload', content=uploaded_file)
+    return create_output(input_id)
+
+def create_output(input_id):
+    """
+    Reserves the output artifact for a stored statement
+    Returns a dict with the ids, paths and display names of input and output
+    """
+    store = get_artifact_store()
+    input_metadata = store.metadata(input_id)
+    input_file_path = store.path(input_id, input_metadata)
+    input_filename = input_metadata['name']
+    
+    # Detect bank format for naming
+    bank_format = detect_bank_format(input_file_path).capitalize()
+    
+    # Generate output filename using <Bank><Name>.csv format
+    # Extract the current timestamp to make filename unique
+    import time
+    timestamp = int(time.time())
+    
+    # Get a name component from the input filename (either a pattern like "Case1" or just a random string)
+    name_match = re.search(r'Case\d+', os.path.splitext(input_filename)[0])
+    if name_match:
+        name_component = name_match.group(0)
+    else:
+        # Use last 4 digits of timestamp if no Case pattern found
+        name_component = f"Statement{timestamp % 10000}"
         
-        # Generate output filename using <Bank><Name>.csv format
-        # Extract the current timestamp to make filename unique
-        import time
-        timestamp = int(time.time())
+    # Output names only label the download; the artifact id keeps them apart
+    output_filename = f"{bank_format}{name_component}.csv"
+    output_compression = getattr(settings, 'OUTPUT_COMPRESSION', None)
+    output_id = store.create(output_filename, 'output', extra={'source': input_id, 'compression': output_compression})
+    
+    return {
+        'input_id': input_id,
+        'input_filename': input_filename,
+        'input_file_path': input_file_path,
+        'output_id': output_id,
+        'output_filename': output_filename,
+        'output_file_path': store.path(output_id),
+        'output_compression': output_compression,
+    }
+
+async def upload_file(request):
+    """Handle file upload and processing"""
+    if request.method != 'POST':
+        return redirect('home')
+    
+    # Parsing the multipart body reads the spooled upload from disk
+    files = await sync_to_async(lambda: request.FILES, thread_sensitive=False)()
+    if not files.get('statement_file'):
+        return redirect('home')
+    
+    # Get uploaded file
+    uploaded_file = files['statement_file']
+    
+    # Check if it's a CSV, plain or compressed
+    if not is_supported_upload(uploaded_file.name):
+        messages.error(request, f"Please upload a CSV file ({', '.join(supported_suffixes())})")
+        return redirect('home')
+    
+    job = await sync_to_async(save_upload, thread_sensitive=False)(uploaded_file)
+    
+    # Process the file in the parse pool
+    admission = get_parse_admission()
+    try:
+        rows_processed = await admission.run(standardize_artifact, get_artifact_store().root, job['input_id'],
+                                             job['output_id'], job['output_compression'])
+    except ParserBusy:
+        messages.error(request, 'The server is busy processing other statements, please try again shortly')
+        return redirect('home')
+    except Exception as e:
+        messages.error(request, f'Error processing file: {str(e)}')
+        return redirect('home')
+    
+    # Prepare context for result page
+    context = {
+        'input_filename': job['input_filename'],
+        'output_filename': job['output_filename'],
+        'output_id': job['output_id'],
+        'rows_processed': rows_processed,
+        'preview': await sync_to_async(load_preview, thread_sensitive=False)(job['output_id'], with_sections=True),
+    }
+    
+    response = render(request, 'result.html', context)
+    response['X-Parse-Queue-Depth'] = admission.stats()['waiting']
+    return response
+
+async def aiter_sync(iterator):
+    """
+    Iterates over a synchronous iterator from async code, one item at a
+    time in a worker thread, closing it when done
+    """
+    next_item = sync_to_async(next, thread_sensitive=False)
+    try:
+        while True:
+            item = await next_item(iterator, None)
+            if item is None:
+                break
+            yield item
+    finally:
+        await sync_to_async(iterator.close, thread_sensitive=False)()
+
+def file_response(request, fh, filename, content_type, decompress=False):
+    """
+    Streams an open file (decompressed if asked) as an attachment
+    Django sends a synchronous iterator over ASGI only after reading it
+    all into a list, and an asynchronous one over WSGI likewise, so the
+    chunks are handed over the way the current server consumes them.
+    """
+    chunks = iter_gunzipped(fh) if decompress else iter_chunks(fh)
+    response = StreamingHttpResponse(aiter_sync(chunks) if isinstance(request, ASGIRequest) else chunks,
+                                     content_type=content_type)
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    if not decompress:
+        response['Content-Length'] = os.fstat(fh.fileno()).st_size
+    return response
+
+def open_output(artifact_id, metadata):
+    """
+    Opens a stored output for reading
+    The shared lock keeps a re-normalization from swapping the file in the
+    meantime; once open, the file reads the same however it is replaced.
+    """
+    store = get_artifact_store()
+    with store.lock(artifact_id, shared=True):
+        return open(store.path(artifact_id, metadata), 'rb')
+
+async def download_file(request, artifact_id):
+    """
+    Download processed file
+    Compressed outputs are sent as stored to clients that accept gzip, and
+    decompressed on the fly for the others; `?format=gz` downloads the
+    .csv.gz file itself.
+    """
+    store = get_artifact_store()
+    
+    try:
+        metadata = await sync_to_async(store.metadata, thread_sensitive=False)(artifact_id)
+        if metadata['kind'] != 'output':
+            raise ArtifactNotFound(artifact_id)
+        # Stream the file instead of reading it into memory
+        fh = await sync_to_async(open_output, thread_sensitive=False)(artifact_id, metadata)
+    except (ArtifactNotFound, FileNotFoundError):
+        messages.error(request, 'File not found')
+        return redirect('home')
+    
+    if metadata.get('compression') != 'gzip':
+        return file_response(request, fh, metadata['name'], 'text/csv')
+    
+    if request.GET.get('format') == 'gz':
+        return file_response(request, fh, metadata['name'] + '.gz', 'application/gzip')
+    
+    if ACCEPTS_GZIP_PATTERN.search(request.headers.get('Accept-Encoding', '')):
+        response = file_response(request, fh, metadata['name'], 'text/csv')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = file_response(request, fh, metadata['name'], 'text/csv', decompress=True)
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+def load_preview(artifact_id, page=1, page_size=PREVIEW_PAGE_SIZE, section=None, card=None, with_sections=False):
+    """
+    Reads one page of a standardized output through its row index
+    A section number or card holder name jumps to the start of that section.
+    The list of sections is only included with with_sections=True.
+    """
+    store = get_artifact_store()
+    metadata = store.metadata(artifact_id)
+    if metadata['kind'] != 'output':
+        raise ArtifactNotFound(artifact_id)
+    # Hold a shared lock so the index and the output are read from the same version
+    with store.lock(artifact_id, shared=True):
+        index = RowIndex(store.path(artifact_id, metadata))
         
-        # Get a name component from the input filename (either a pattern like "Case1" or just a random string)
-        name_match = re.search(r'Case\d+', os.path.splitext(input_filename)[0])
-        if name_match:
-            name_component = name_match.group(0)
+        if section is not None:
+            if not 0 <= section < len(index.sections):
+                raise ValueError('Unknown section')
+            start = index.sections[section]['first_row']
+        elif card is not None:
+            cards = index.cards()
+            if card not in cards:
+                raise ValueError('Unknown card holder')
+            start = cards[card]
         else:
-            # Use last 4 digits of timestamp if no Case pattern found
-            name_component = f"Statement{timestamp % 10000}"
-            
-        output_filename = f"{bank_format}{name_component}.csv"
-        output_file_path = os.path.join(settings.MEDIA_ROOT, output_filename)
+            start = (max(page, 1) - 1) * page_size
         
-        # Process the file
-        try:
-            rows_processed = standardize_statement(input_file_path, output_file_path)
-            
-            # Prepare context for result page
-            context = {
-                'input_filename': input_filename,
-                'output_filename': output_filename,
-                'rows_processed': rows_processed
-            }
-            
-            return render(request, 'result.html', context)
-            
-        except Exception as e:
-            messages.error(request, f'Error processing file: {str(e)}')
-            return redirect('home')
-    
-    return redirect('home')
-
-def download_file(request, filename):
-    """Download processed file"""
-    file_path = os.path.join(settings.MEDIA_ROOT, filename)
-    
-    if os.path.exists(file_path):
-        with open(file_path, 'rb') as fh:
-            response = HttpResponse(fh.read(), content_type='text/csv')
-            response['Content-Disposition'] = f'attachment; filename="{filename}"'
-            return response
-    
-    messages.error(request, 'File not found')
-    return redirect('home')
+        rows = index.read_rows(start, page_size)
+        sections = index.sections if with_sections else None
+    
+    preview = {
+        'columns': OUTPUT_FIELDS,
+        'rows': [[row.get(column, '') for column in OUTPUT_FIELDS] for row in rows],
+        'start': start,
+        'page': start // page_size + 1,
+        'page_size': page_size,
+        'total_rows': index.row_count,
+        'pages': max((index.row_count + page_size - 1) // page_size, 1),
+    }
+    if with_sections:
+        preview['sections'] = sections
+    return preview
+
+async def preview_file(request, artifact_id):
+    """JSON API for paginated previews of a processed file"""
+    try:
+        page = int(request.GET.get('page', 1))
+        page_size = min(max(int(request.GET.get('size', PREVIEW_PAGE_SIZE)), 1), MAX_PREVIEW_PAGE_SIZE)
+        section = int(request.GET['section']) if 'section' in request.GET else None
+    except ValueError:
+        return JsonResponse({'error': 'page, size and section must be numbers'}, status=400)
+    
+    try:
+        preview = await sync_to_async(load_preview, thread_sensitive=False)(
+            artifact_id, page, page_size, section, request.GET.get('card'), 'sections' in request.GET)
+    except (ArtifactNotFound, FileNotFoundError):
+        return JsonResponse({'error': 'File not found'}, status=404)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    return JsonResponse(preview)
+
+def chunked_upload_init(request):
+    """Start a resumable chunked upload; takes `filename` and optionally `size`"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    
+    filename = request.POST.get('filename', '')
+    if not is_supported_upload(filename):
+        return JsonResponse({'error': f"Please upload a CSV file ({', '.join(supported_suffixes())})"}, status=400)
+    try:
+        size = int(request.POST['size']) if request.POST.get('size') else None
+        upload_id = init_upload(get_artifact_store(), filename, size)
+    except (ValueError, ChunkError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    return JsonResponse(upload_status(get_artifact_store(), upload_id), status=201)
+
+def chunked_upload_status(request, upload_id):
+    """Report received ranges and parse progress, e.g. to resume an upload"""
+    try:
+        return JsonResponse(upload_status(get_artifact_store(), upload_id))
+    except (ArtifactNotFound, ChunkError):
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+
+def reserve_output(upload_id):
+    """Creates the output of a chunked upload; returns its id and compression"""
+    output = create_output(upload_id)
+    return output['output_id'], output['output_compression']
+
+def store_chunk(upload_id, offset, data, checksum):
+    """
+    Stores a chunk and sets up incremental parsing once enough has arrived
+    """
+    store = get_artifact_store()
+    status = append_chunk(store, upload_id, offset, data, checksum)
+    start_parse(store, upload_id, reserve_output)
+    return status
+
+async def chunked_upload_append(request, upload_id):
+    """
+    Append a chunk; the raw body is written at `?offset=` and must match
+    the X-Chunk-Sha256 header. Whatever is now contiguous gets parsed.
+    """
+    if request.method not in ('POST', 'PUT'):
+        return JsonResponse({'error': 'POST or PUT required'}, status=405)
+    try:
+        offset = int(request.GET['offset'])
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'offset must be given as a number'}, status=400)
+    if length > settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE:
+        return JsonResponse({'error': 'Chunk too large'}, status=413)
+    
+    data = await sync_to_async(request.read, thread_sensitive=False)()
+    try:
+        status = await sync_to_async(store_chunk, thread_sensitive=False)(
+            upload_id, offset, data, request.headers.get('X-Chunk-Sha256'))
+    except ArtifactNotFound:
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+    except ChunkError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    # Parse what has arrived so far; if the parsers are busy it catches up later
+    try:
+        status = await get_parse_admission().run(advance_parse, get_artifact_store().root, upload_id)
+    except ParserBusy:
+        pass
+    return JsonResponse(status)
+
+def close_upload(upload_id):
+    """Marks an upload complete and makes sure its parse is set up"""
+    store = get_artifact_store()
+    mark_complete(store, upload_id)
+    start_parse(store, upload_id, reserve_output)
+
+async def chunked_upload_complete(request, upload_id):
+    """Finish a chunked upload; returns the output once it is normalized"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    try:
+        await sync_to_async(close_upload, thread_sensitive=False)(upload_id)
+        status = await get_parse_admission().run(finish_upload, get_artifact_store().root, upload_id)
+    except ArtifactNotFound:
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+    except ChunkError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except ParserBusy as e:
+        return JsonResponse({'error': str(e)}, status=503, headers={'Retry-After': '5'})
+    except Exception as e:
+        return JsonResponse({'error': f'Error processing file: {str(e)}'}, status=500)
+    
+    status['rows_processed'] = status['rows']
+    status['download_url'] = reverse('download_file', args=[status['output_id']])
+    status['preview_url'] = reverse('preview_file', args=[status['output_id']])
+    return JsonResponse(status)
+
+def parse_status(request):
+    """Report the parse queue depth, artifact eviction statistics and reference table version"""
+    status = get_parse_admission().stats()
+    status['artifacts'] = get_artifact_store().stats()
+    status['reference_tables'] = get_table_loader().stats()
+    return JsonResponse(status)